@@ -0,0 +1,69 @@
+# benchmarks/seed.py
+
+import random
+from datetime import time
+from typing import List
+
+import asyncpg
+
+from benchmarks.stubs import city_id_for
+
+# Пользователи нагрузочного теста получают id начиная с этого значения
+USER_ID_OFFSET = 10_000_000
+
+def city_name(number: int) -> str:
+    return f"Город {number}"
+
+def _pick_city(cities: int) -> int:
+    # Популярность городов убывает примерно по закону Ципфа
+    return min(int(random.paretovariate(1.2)) - 1, cities - 1)
+
+async def seed(pool: asyncpg.pool.Pool, subscriptions: int, cities: int, hot_time: time, hot_share: float) -> List[int]:
+    """
+    Заполняет базу синтетическими подписками и избранными городами.
+
+    Таблицы бота предварительно очищаются: запускать только на отдельной базе.
+    Возвращает id пользователей.
+    """
+    random.seed(42)
+    users = max(1, subscriptions * 2 // 3)
+    user_ids = [USER_ID_OFFSET + i for i in range(users)]
+
+    async with pool.acquire() as conn:
+        await conn.execute('TRUNCATE users, user_cities, deliveries, city_aliases, cities, cache_entries, fsm_states')
+
+        await conn.copy_records_to_table(
+            'cities',
+            records=[(city_id_for(n), city_name(n), 'RU', 55.0, 37.0) for n in range(cities)],
+            columns=['id', 'name', 'country', 'lat', 'lon'],
+        )
+        await conn.copy_records_to_table(
+            'city_aliases',
+            records=[(city_name(n).casefold(), city_id_for(n)) for n in range(cities)],
+            columns=['alias', 'city_id'],
+        )
+
+        rows = []
+        for i in range(subscriptions):
+            number = _pick_city(cities)
+            if random.random() < hot_share:
+                notification_time = hot_time
+            else:
+                notification_time = time(random.randrange(24), random.randrange(60))
+            rows.append((user_ids[i % users], city_name(number), city_id_for(number), notification_time))
+        await conn.copy_records_to_table(
+            'users', records=rows, columns=['user_id', 'city', 'city_id', 'notification_time'],
+        )
+
+        favorites = {}
+        for user_id in user_ids:
+            for _ in range(random.randint(1, 3)):
+                number = _pick_city(cities)
+                favorites[user_id, number] = random.randint(1, 20)
+        await conn.copy_records_to_table(
+            'user_cities',
+            records=[(user_id, city_name(n), city_id_for(n), count) for (user_id, n), count in favorites.items()],
+            columns=['user_id', 'city', 'city_id', 'frequency'],
+        )
+        await conn.execute('ANALYZE')
+    return user_ids
@@ -0,0 +1,166 @@
+# benchmarks/stubs.py
+
+import asyncio
+import random
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from aiohttp import web
+
+class StubServer:
+    """
+    Локальный aiohttp-сервер с настраиваемой задержкой, долей ошибок 5xx и ответов 429.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.calls: Counter = Counter()  # (метод, статус) -> число вызовов
+        self.app = web.Application()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ''
+
+    async def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _fault(self) -> Optional[int]:
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self) -> Dict[str, int]:
+        return {f"{method} {status}": count for (method, status), count in sorted(self.calls.items())}
+
+class OpenWeatherStub(StubServer):
+    """
+    Заглушка OpenWeather: /forecast?id=, /group?id= и /weather?q= для городов «Город N».
+    """
+    def __init__(self, cities: int, **kwargs):
+        super().__init__(**kwargs)
+        self.cities = cities
+        self.app.router.add_get('/forecast', self.forecast)
+        self.app.router.add_get('/weather', self.weather)
+        self.app.router.add_get('/group', self.group)
+
+    async def _respond(self, method: str, payload) -> web.Response:
+        await self._delay()
+        status = self._fault()
+        if status is not None:
+            self.calls[method, status] += 1
+            return web.json_response({'cod': status, 'message': 'stub fault'}, status=status)
+        if payload is None:
+            self.calls[method, 404] += 1
+            return web.json_response({'cod': '404', 'message': 'city not found'}, status=404)
+        self.calls[method, 200] += 1
+        return web.json_response(payload)
+
+    async def forecast(self, request: web.Request) -> web.Response:
+        city_id = int(request.query.get('id', 0))
+        payload = None
+        if city_id_in_range(city_id, self.cities):
+            now = int(time.time()) // 10800 * 10800
+            payload = {
+                'cod': '200',
+                'list': [
+                    {
+                        'dt': now + i * 10800,
+                        'main': {'temp': round(random.uniform(-20, 30), 2)},
+                        'weather': [{'description': random.choice(('ясно', 'облачно', 'небольшой дождь', 'снег'))}],
+                    }
+                    for i in range(40)
+                ],
+            }
+        return await self._respond('forecast', payload)
+
+    def _current(self, city_id: int) -> dict:
+        return {
+            'id': city_id,
+            'name': f"Город {city_id - CITY_ID_OFFSET}",
+            'dt': int(time.time()),
+            'main': {'temp': round(random.uniform(-20, 30), 2), 'feels_like': round(random.uniform(-25, 30), 2)},
+            'weather': [{'description': random.choice(('ясно', 'облачно', 'небольшой дождь', 'снег'))}],
+        }
+
+    async def group(self, request: web.Request) -> web.Response:
+        city_ids = [int(value) for value in request.query.get('id', '').split(',') if value]
+        if len(city_ids) > 20:
+            await self._delay()
+            self.calls['group', 400] += 1
+            return web.json_response({'cod': '400', 'message': 'too many ids'}, status=400)
+        found = [self._current(city_id) for city_id in city_ids if city_id_in_range(city_id, self.cities)]
+        return await self._respond('group', {'cnt': len(found), 'list': found})
+
+    async def weather(self, request: web.Request) -> web.Response:
+        name = request.query.get('q', '')
+        payload = None
+        if name.startswith('Город '):
+            city_id = city_id_for(int(name.split()[-1]))
+            if city_id_in_range(city_id, self.cities):
+                payload = {'id': city_id, 'name': name, 'coord': {'lat': 55.0, 'lon': 37.0}, 'sys': {'country': 'RU'}}
+        return await self._respond('weather', payload)
+
+class TelegramStub(StubServer):
+    """
+    Заглушка Bot API: принимает любой метод, на sendMessage возвращает сообщение.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._message_id = 0
+        self.app.router.add_post('/bot{token}/{method}', self.method)
+
+    async def method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        data = await request.post() if request.content_type != 'application/json' else await request.json()
+        await self._delay()
+        status = self._fault()
+        if status == 429:
+            self.calls[method, 429] += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }, status=429)
+        if status is not None:
+            self.calls[method, status] += 1
+            return web.json_response({'ok': False, 'error_code': status, 'description': 'Internal Server Error'}, status=status)
+
+        self.calls[method, 200] += 1
+        if method.lower() != 'sendmessage':
+            return web.json_response({'ok': True, 'result': True})
+        self._message_id += 1
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+            'text': data.get('text', ''),
+        }})
+
+# Города заглушки получают id 1000 + N, чтобы не пересекаться с реальными id OpenWeather в логах
+CITY_ID_OFFSET = 1000
+
+def city_id_for(number: int) -> int:
+    return CITY_ID_OFFSET + number
+
+def city_id_in_range(city_id: int, cities: int) -> bool:
+    return CITY_ID_OFFSET <= city_id < CITY_ID_OFFSET + cities
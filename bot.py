@@ -2,100 +2,306 @@
 
 import asyncio
 import logging
-import sys
-import logging.handlers  # Для RotatingFileHandler
+import os
+import signal
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from aiolimiter import AsyncLimiter
-from datetime import datetime
-import pytz
 
 from config import settings
-from database import Database
-from middlewares import DatabaseMiddleware, RateLimitMiddleware
+from cities import CityResolver
+from citylist import CityIndex
+from database import Database, Repository
+from deliveries import DeliveryCoordinator
+from fsm_storage import PostgresStorage
+from logs import setup_logging
+import metrics
+from middlewares import DatabaseMiddleware, MetricsMiddleware, RateLimitMiddleware, ServicesMiddleware
+from sender import MessageSender
+from prefetch import Prefetcher
+from scheduler import deliver_overdue, run_delivery_loop
+from subscriptions import SubscriptionIndex, MOSCOW_TZ
 from handlers import router
-from weather import get_weather
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] %(levelname)s:%(name)s:%(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.handlers.RotatingFileHandler('bot.log', maxBytes=1_000_000, backupCount=5)  # Исправлено здесь
-    ]
-)
+from cache import MemoryBackend, PostgresBackend, TwoTierCache
+from webhook import WebhookServer
+from weather import breaker, budget, group_batcher, init_http_session, close_http_session, configure_cache, get_conditions_cache
 
 logger = logging.getLogger(__name__)
 
-# Часовой пояс Москвы
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+async def log_sender_stats(sender: MessageSender):
+    stats = sender.stats()
+    if stats['throughput'] or any(stats['queue_depth'].values()) or stats['delayed']:
+        logger.info("Очередь отправки: %s", stats)
+
+async def log_rate_limit_stats(middleware: RateLimitMiddleware):
+    stats = middleware.stats()
+    if stats['rejected_user'] or stats['rejected_global']:
+        logger.info("Ограничение частоты запросов: %s", stats)
+
+async def log_prefetch_stats(prefetcher: Prefetcher):
+    logger.info("Упреждающая загрузка: %s", prefetcher.stats())
+
+async def log_cache_stats(cache: TwoTierCache):
+    logger.info("Кэш %s: %s", cache.namespace, cache.stats())
+
+async def log_group_batches():
+    stats = group_batcher.stats()
+    if stats['requested']:
+        logger.info("Пачки запросов текущей погоды: %s", stats)
+
+async def log_breaker_state():
+    if breaker.state != breaker.CLOSED:
+        logger.warning("OpenWeather недоступен, отдаются сохранённые прогнозы: %s", breaker.snapshot())
+
+async def log_budget_usage():
+    usage = budget.usage()
+    if usage['minute_used'] or any(usage['waiting'].values()):
+        logger.info("Бюджет вызовов OpenWeather: %s", usage)
+
+async def log_delivery_stats(coordinator: DeliveryCoordinator):
+    logger.info("Очередь рассылки: %s", coordinator.stats())
+
+async def prune_deliveries(coordinator: DeliveryCoordinator):
+    removed = await coordinator.prune(settings.DELIVERY_RETENTION_DAYS)
+    if removed:
+        logger.info("Удалено %s старых записей рассылки.", removed)
+
+async def log_query_stats(repo: Repository):
+    logger.info("Запросы к базе данных: %s", repo.stats.snapshot())
+    logger.info("Кэш подписок пользователей: %s", repo.subscription_cache_stats())
+
+async def purge_fsm_states(storage: PostgresStorage):
+    removed = await storage.purge_expired()
+    if removed:
+        logger.info("Удалено %s устаревших состояний диалогов.", removed)
+
+async def purge_cache(backend):
+    removed = await backend.purge_expired()
+    if removed:
+        logger.info("Удалено %s устаревших записей общего кэша.", removed)
+
+async def load_city_index(city_index: CityIndex, repo: Repository):
+    """
+    Строит индекс подсказок из списка городов OpenWeather и справочника бота.
+    Разбор файла и сортировка идут в отдельном потоке; до готовности подсказки пустые.
+    """
+    path = settings.CITY_LIST_PATH
+    if path and os.path.exists(path):
+        cities = await asyncio.to_thread(CityIndex.read_file, path)
+    else:
+        cities = []
+        logger.warning("Список городов %s не найден, подсказки только по справочнику бота.", path)
+    known = await repo.all_cities()
+    await asyncio.to_thread(city_index.build, cities, known)
+    logger.info("Индекс подсказок городов построен: %s записей.", len(city_index))
 
-async def send_weather_update(db_pool, bot: Bot):
+async def run_webhook(dp: Dispatcher, bot: Bot, health):
+    server = WebhookServer(
+        dp,
+        bot,
+        path=settings.WEBHOOK_PATH,
+        secret=settings.WEBHOOK_SECRET,
+        max_concurrency=settings.WEBHOOK_MAX_CONCURRENCY,
+        max_pending=settings.WEBHOOK_MAX_PENDING,
+        health=health,
+    )
+    await server.start(settings.WEBHOOK_HOST, settings.WEBHOOK_PORT)
+
+    # Без WEBHOOK_URL вебхук в Telegram не регистрируется: так сервер можно проверять локально
+    if settings.WEBHOOK_URL:
+        await bot.set_webhook(
+            settings.WEBHOOK_URL.rstrip('/') + settings.WEBHOOK_PATH,
+            secret_token=settings.WEBHOOK_SECRET,
+            max_connections=settings.WEBHOOK_MAX_CONCURRENCY,
+        )
+        logger.info("Вебхук зарегистрирован в Telegram.")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
     try:
-        now = datetime.now(MOSCOW_TZ).time().replace(second=0, microsecond=0)
-        logger.info(f"Выполнение запланированной задачи на время: {now.strftime('%H:%M')}")
-
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch('SELECT user_id, city FROM users WHERE notification_time = $1', now)
-            logger.info(f"Найдено {len(rows)} пользователей для уведомления.")
-
-            for row in rows:
-                user_id = row['user_id']
-                city = row['city']
-                logger.info(f"Отправка прогноза погоды пользователю {user_id} для города {city}.")
-                weather_data = await get_weather(city, hours=24)
-                if weather_data:
-                    forecast_message = f"Прогноз погоды для {city} на ближайшие 24 часа:\n"
-                    forecasts = weather_data.get('list', [])[:8]  # 8 прогнозов (3 часа)
-
-                    for forecast in forecasts:
-                        dt_txt = forecast['dt_txt']
-                        temp = forecast['main']['temp']
-                        description = forecast['weather'][0]['description']
-                        forecast_message += f"{dt_txt}: {temp}°C, {description}\n"
-
-                    await bot.send_message(user_id, forecast_message)
-                    logger.info(f"Отправлен прогноз погоды пользователю {user_id}")
-                else:
-                    await bot.send_message(user_id, "Не удалось получить данные о погоде.")
-                    logger.warning(f"Не удалось получить данные о погоде для города: {city}")
-    except Exception as e:
-        logger.error(f"Ошибка при выполнении запланированной задачи: {e}")
+        await stop.wait()
+    finally:
+        await server.stop()
 
 async def main():
     # Инициализация базы данных
     db = Database()
     await db.connect()
 
+    # Общий HTTP-клиент для запросов к OpenWeather
+    await init_http_session()
+
+    # Общий уровень кэша прогнозов
+    if settings.CACHE_BACKEND == 'postgres':
+        cache_backend = PostgresBackend(db.pool)
+    else:
+        cache_backend = MemoryBackend()
+    forecast_cache = configure_cache(cache_backend)
+
+    # Справочник городов; старые записи сопоставляются с ним в фоне
+    city_index = CityIndex()
+    resolver = CityResolver(db.repo, city_index)
+
+    # Индекс подписок по минутам суток
+    index = SubscriptionIndex()
+    await index.load(db.repo)
+
     # Инициализация бота
-    bot = Bot(token=settings.TELEGRAM_TOKEN, parse_mode='HTML')
-    dp = Dispatcher()
+    session = None
+    if settings.TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL))
+    bot = Bot(token=settings.TELEGRAM_TOKEN, session=session, parse_mode='HTML')
+    fsm_storage = None
+    if settings.FSM_STORAGE == 'postgres':
+        fsm_storage = PostgresStorage(
+            db.pool,
+            ttl=settings.FSM_TTL,
+            local_ttl=settings.FSM_LOCAL_TTL,
+            local_size=settings.FSM_LOCAL_SIZE,
+        )
+        dp = Dispatcher(storage=fsm_storage)
+    else:
+        dp = Dispatcher()
+
+    # Очередь исходящих сообщений с ограничением скорости
+    sender = MessageSender(
+        bot,
+        workers=settings.SENDER_WORKERS,
+        global_rate=settings.SEND_GLOBAL_RATE,
+        chat_rate=settings.SEND_CHAT_RATE,
+        chat_burst=settings.SEND_CHAT_BURST,
+        max_retries=settings.SEND_MAX_RETRIES,
+    )
+    sender.start()
 
     # Настройка middleware
-    limiter = AsyncLimiter(5, 60)  # 5 запросов в минуту на пользователя
     db_middleware = DatabaseMiddleware(db)
-    rate_limit_middleware = RateLimitMiddleware(limiter)
+    rate_limit_middleware = RateLimitMiddleware(
+        user_rate=settings.RATE_LIMIT_USER_RATE,
+        user_burst=settings.RATE_LIMIT_USER_BURST,
+        global_rate=settings.RATE_LIMIT_GLOBAL_RATE,
+        max_users=settings.RATE_LIMIT_MAX_USERS,
+    )
+    services_middleware = ServicesMiddleware(sender=sender, index=index, resolver=resolver, city_index=city_index)
+    # Замер времени первым: в него попадают и остальные middleware
+    dp.message.middleware(MetricsMiddleware('message'))
+    dp.callback_query.middleware(MetricsMiddleware('callback_query'))
+    dp.inline_query.middleware(MetricsMiddleware('inline_query'))
     dp.message.middleware(db_middleware)
     dp.callback_query.middleware(db_middleware)
+    dp.inline_query.middleware(db_middleware)
+    dp.message.middleware(services_middleware)
+    dp.callback_query.middleware(services_middleware)
+    dp.inline_query.middleware(services_middleware)
     dp.message.middleware(rate_limit_middleware)
     dp.callback_query.middleware(rate_limit_middleware)
+    # Инлайн-подсказки не ограничиваются: Telegram шлёт запрос на каждую букву, а ответ
+    # не ходит во внешние API и не отправляет сообщений, только ищет в памяти
 
     # Регистрируем роутеры
     dp.include_router(router)
 
     # Настройка планировщика
     scheduler = AsyncIOScheduler(timezone=MOSCOW_TZ)
-    scheduler.add_job(send_weather_update, 'cron', minute='*', args=[db.pool, bot])
+    scheduler.add_job(index.load, 'interval', minutes=settings.SUBSCRIPTION_RESYNC_MINUTES, args=[db.repo])
+    scheduler.add_job(log_sender_stats, 'interval', minutes=1, args=[sender])
+    scheduler.add_job(log_breaker_state, 'interval', minutes=1)
+    scheduler.add_job(log_rate_limit_stats, 'interval', minutes=10, args=[rate_limit_middleware])
+    scheduler.add_job(log_budget_usage, 'interval', minutes=1)
+    scheduler.add_job(purge_cache, 'interval', minutes=settings.CACHE_PURGE_MINUTES, args=[cache_backend])
+    scheduler.add_job(log_cache_stats, 'interval', minutes=10, args=[forecast_cache])
+    scheduler.add_job(log_cache_stats, 'interval', minutes=10, args=[resolver.cache])
+    scheduler.add_job(log_cache_stats, 'interval', minutes=10, args=[get_conditions_cache()])
+    scheduler.add_job(log_group_batches, 'interval', minutes=10)
+    scheduler.add_job(log_query_stats, 'interval', minutes=10, args=[db.repo])
+    if fsm_storage is not None:
+        scheduler.add_job(purge_fsm_states, 'interval', minutes=settings.FSM_PURGE_MINUTES, args=[fsm_storage])
     scheduler.start()
+    background_tasks = [
+        asyncio.create_task(db.build_indexes()),
+        asyncio.create_task(resolver.backfill()),
+        asyncio.create_task(load_city_index(city_index, db.repo)),
+        asyncio.create_task(db.repo.run_city_use_flusher()),
+    ]
+    prefetcher = None
+    if settings.PREFETCH_ENABLED:
+        if settings.SCHEDULED_FORMAT == 'summary':
+            prefetcher = Prefetcher(
+                index, settings.PREFETCH_CONDITIONS_WINDOW_MINUTES, get_conditions_cache(),
+                conditions=True, group_size=settings.GROUP_BATCH_SIZE,
+            )
+        else:
+            prefetcher = Prefetcher(index, settings.PREFETCH_WINDOW_MINUTES, forecast_cache)
+        background_tasks.append(asyncio.create_task(prefetcher.run()))
+        scheduler.add_job(log_prefetch_stats, 'interval', minutes=10, args=[prefetcher])
+    # Очередь плановой рассылки в таблице deliveries
+    coordinator = DeliveryCoordinator(
+        db.pool,
+        batch_size=settings.DELIVERY_CLAIM_BATCH,
+        lease=settings.DELIVERY_CLAIM_LEASE,
+        replica_id=settings.REPLICA_ID,
+        flush_interval=settings.DELIVERY_STATUS_FLUSH_SECONDS,
+        flush_size=settings.DELIVERY_STATUS_FLUSH_SIZE,
+    )
+    background_tasks.append(asyncio.create_task(coordinator.run()))
+    scheduler.add_job(
+        deliver_overdue, 'interval', minutes=1, args=[coordinator, sender, resolver, prefetcher],
+        max_instances=1, coalesce=True,
+    )
+    scheduler.add_job(prune_deliveries, 'interval', hours=1, args=[coordinator])
+    scheduler.add_job(log_delivery_stats, 'interval', minutes=10, args=[coordinator])
+    background_tasks.append(asyncio.create_task(run_delivery_loop(index, coordinator, sender, resolver, prefetcher)))
     logger.info("Планировщик задач запущен.")
 
+    metrics_server = None
+    if settings.METRICS_ENABLED:
+        metrics.register_runtime(metrics.RuntimeCollector(db.pool, sender=sender, coordinator=coordinator, breaker=breaker))
+        # Только на отдельном порту: сервер вебхука доступен из интернета
+        metrics_server = await metrics.start_server(settings.METRICS_HOST, settings.METRICS_PORT)
+
+    def health():
+        return {
+            'mode': settings.BOT_MODE,
+            'breaker': breaker.state,
+            'send_queue': sender.stats()['queue_depth'],
+            'subscriptions': len(index),
+        }
+
     try:
-        logger.info("Запуск бота")
-        await dp.start_polling(bot)
+        logger.info("Запуск бота в режиме %s", settings.BOT_MODE)
+        if settings.BOT_MODE == 'webhook':
+            await run_webhook(dp, bot, health)
+        else:
+            await dp.start_polling(bot)
     finally:
+        scheduler.shutdown(wait=False)
+        for task in background_tasks:
+            task.cancel()
+        await metrics.stop_server(metrics_server)
+        await sender.stop()
+        # Статусы сообщений, доставленных при остановке, записываем до закрытия пула
+        await coordinator.flush()
+        await db.repo.flush_city_uses()
         await bot.close()
+        await close_http_session()
         await db.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Запись логов в файл и ротация идут в отдельном потоке, а не в цикле событий
+    listener = setup_logging(
+        level=settings.LOG_LEVEL,
+        path=settings.LOG_FILE,
+        max_bytes=settings.LOG_MAX_BYTES,
+        backup_count=settings.LOG_BACKUP_COUNT,
+        queued=settings.LOG_QUEUE,
+        sample_burst=settings.LOG_SAMPLE_BURST,
+        sample_interval=settings.LOG_SAMPLE_INTERVAL,
+    )
+    try:
+        asyncio.run(main())
+    finally:
+        if listener is not None:
+            listener.stop()
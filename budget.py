@@ -0,0 +1,114 @@
+# budget.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict
+
+from ratelimit import Priority, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+class UpstreamBudget:
+    """
+    Общий бюджет вызовов внешнего API с квотой в минуту и в сутки.
+
+    Интерактивные запросы могут расходовать всю квоту; плановым и упреждающим
+    остаётся квота за вычетом резерва и они уступают очередь, пока ждут более
+    приоритетные. Если токен не удаётся получить за max_wait секунд, вызов
+    не выполняется и вызывающий код отдаёт данные из кэша.
+    """
+    def __init__(
+        self,
+        per_minute: int,
+        per_day: int,
+        reserve: float,
+        max_wait: Dict[Priority, float],
+    ):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.reserve = reserve
+        self.max_wait = max_wait
+        # Ёмкость — десятая часть минутной квоты, чтобы всплеск не выбрал её целиком за секунду
+        self._bucket = TokenBucket(per_minute / 60.0, max(1.0, per_minute / 10.0))
+        self._calls: Deque[float] = deque()
+        self._day = self._today()
+        self.day_used = 0
+        self._waiting = {priority: 0 for priority in Priority}
+
+        self.granted = {priority: 0 for priority in Priority}
+        self.rejected = {priority: 0 for priority in Priority}
+
+    @staticmethod
+    def _today():
+        # Суточная квота OpenWeather считается по UTC
+        return datetime.now(timezone.utc).date()
+
+    def _day_limit(self, priority: Priority) -> float:
+        if priority == Priority.INTERACTIVE:
+            return self.per_day
+        return self.per_day * (1.0 - self.reserve)
+
+    def _threshold(self, priority: Priority) -> float:
+        if priority == Priority.INTERACTIVE:
+            return 1.0
+        # При маленькой квоте резерв не должен поднять порог выше ёмкости: иначе токен не получить никогда
+        return min(1.0 + self._bucket.capacity * self.reserve, self._bucket.capacity)
+
+    def _blocked_by_higher(self, priority: Priority) -> bool:
+        return any(count for other, count in self._waiting.items() if other < priority)
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE) -> bool:
+        """
+        Резервирует один вызов API. Возвращает False, если бюджет не позволил его сделать вовремя.
+        """
+        deadline = time.monotonic() + self.max_wait.get(priority, 0.0)
+        self._waiting[priority] += 1
+        try:
+            while True:
+                today = self._today()
+                if today != self._day:
+                    self._day, self.day_used = today, 0
+                if self.day_used >= self._day_limit(priority):
+                    break
+
+                wait = self._bucket.delay(self._threshold(priority))
+                if wait <= 0 and not self._blocked_by_higher(priority):
+                    self._bucket.tokens -= 1
+                    self.day_used += 1
+                    self.granted[priority] += 1
+                    self._calls.append(time.monotonic())
+                    self._trim_calls()
+                    return True
+
+                wait = max(wait, 0.05)
+                if time.monotonic() + wait > deadline:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting[priority] -= 1
+
+        self.rejected[priority] += 1
+        return False
+
+    def _trim_calls(self):
+        threshold = time.monotonic() - 60.0
+        while self._calls and self._calls[0] < threshold:
+            self._calls.popleft()
+
+    def usage(self) -> Dict[str, Any]:
+        """
+        Текущий расход относительно квоты.
+        """
+        self._trim_calls()
+        return {
+            'minute_used': len(self._calls),
+            'minute_quota': self.per_minute,
+            'day_used': self.day_used,
+            'day_quota': self.per_day,
+            'waiting': {priority.name.lower(): count for priority, count in self._waiting.items()},
+            'granted': {priority.name.lower(): count for priority, count in self.granted.items()},
+            'rejected': {priority.name.lower(): count for priority, count in self.rejected.items()},
+        }
@@ -0,0 +1,285 @@
+# cache.py
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import asyncpg
+
+from metrics import CACHE_ERRORS, CACHE_REQUESTS, DB_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class LoadCancelled(Exception):
+    """
+    Вызов, который загружал значение для get_or_load, был отменён, не дождавшись результата.
+    """
+
+# Сколько устаревших записей общего кэша удаляется одним запросом
+PURGE_BATCH = 10_000
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш в памяти процесса с TTL и вытеснением давно не использованных записей.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def remaining(self, key: str) -> float:
+        """
+        Сколько секунд осталось жить записи (0, если её нет); порядок вытеснения не меняется.
+        """
+        item = self._data.get(key)
+        return max(item[0] - time.monotonic(), 0.0) if item is not None else 0.0
+
+    def set(self, key: str, value: Any, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class MemoryBackend:
+    """
+    Общий уровень кэша в памяти процесса. Заменяет внешнее хранилище при локальном
+    запуске и в нагрузочных тестах; между процессами не разделяется.
+    """
+    def __init__(self):
+        self._data: Dict[str, Tuple[float, str]] = {}
+
+    async def get(self, key: str) -> Optional[Tuple[str, float]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            del self._data[key]
+            return None
+        return value, remaining
+
+    async def set(self, key: str, value: str, ttl: float):
+        self._data[key] = (time.time() + ttl, value)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+class PostgresBackend:
+    """
+    Общий уровень кэша в таблице cache_entries: переживает перезапуск и доступен всем репликам.
+    """
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+
+    async def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with DB_QUERY_SECONDS.labels('cache_get').time():
+            row = await self.pool.fetchrow('''
+                SELECT value, EXTRACT(EPOCH FROM expires_at - now()) AS remaining
+                FROM cache_entries
+                WHERE key = $1 AND expires_at > now()
+            ''', key)
+        if row is None:
+            return None
+        return row['value'], float(row['remaining'])
+
+    async def set(self, key: str, value: str, ttl: float):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        with DB_QUERY_SECONDS.labels('cache_set').time():
+            await self.pool.execute('''
+                INSERT INTO cache_entries (key, value, expires_at)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (key) DO UPDATE
+                SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            ''', key, value, expires_at)
+
+    async def delete(self, key: str):
+        await self.pool.execute('DELETE FROM cache_entries WHERE key = $1', key)
+
+    async def purge_expired(self) -> int:
+        """
+        Удаляет устаревшие записи порциями, не блокируя таблицу надолго.
+        """
+        removed = 0
+        while True:
+            result = await self.pool.execute('''
+                DELETE FROM cache_entries
+                WHERE key IN (
+                    SELECT key FROM cache_entries WHERE expires_at <= now() LIMIT $1
+                )
+            ''', PURGE_BATCH)
+            count = int(result.split()[-1])
+            removed += count
+            if count < PURGE_BATCH:
+                return removed
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+class TwoTierCache:
+    """
+    Двухуровневый кэш одного типа данных: LRU в памяти процесса перед общим уровнем.
+
+    Одновременные промахи по одному ключу сводятся в одну загрузку, поэтому
+    холодный кэш после перезапуска не порождает лавину запросов к источнику.
+    """
+    def __init__(
+        self,
+        namespace: str,
+        ttl: float,
+        backend=None,
+        local_size: int = 10_000,
+        dumps: Callable[[Any], str] = _dumps,
+        loads: Callable[[str], Any] = json.loads,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.backend = backend
+        self.local = LRUCache(local_size)
+        self.dumps = dumps
+        self.loads = loads
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get(self, key: str, min_ttl: float = 0.0) -> Optional[Any]:
+        """
+        Значение из кэша. Запись, которой осталось жить меньше min_ttl секунд, считается промахом.
+        """
+        value = self.local.get(key) if not min_ttl or self.local.remaining(key) >= min_ttl else None
+        if value is not None:
+            self.local_hits += 1
+            CACHE_REQUESTS.labels(self.namespace, 'local_hit').inc()
+            return value
+
+        if self.backend is not None:
+            try:
+                item = await self.backend.get(self._key(key))
+                if item is not None and item[1] < min_ttl:
+                    item = None
+                if item is not None:
+                    raw, remaining = item
+                    item = self.loads(raw), remaining
+            except Exception as e:
+                self.errors += 1
+                CACHE_ERRORS.labels(self.namespace).inc()
+                logger.error("Ошибка чтения общего кэша %s по ключу %s: %s", self.namespace, key, e)
+                item = None
+            if item is not None:
+                value, remaining = item
+                # Локальная копия живёт не дольше записи в общем уровне
+                self.local.set(key, value, min(self.ttl, remaining))
+                self.shared_hits += 1
+                CACHE_REQUESTS.labels(self.namespace, 'shared_hit').inc()
+                return value
+
+        self.misses += 1
+        CACHE_REQUESTS.labels(self.namespace, 'miss').inc()
+        return None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl)
+        if self.backend is not None:
+            try:
+                await self.backend.set(self._key(key), self.dumps(value), ttl)
+            except Exception as e:
+                self.errors += 1
+                CACHE_ERRORS.labels(self.namespace).inc()
+                logger.error("Ошибка записи общего кэша %s по ключу %s: %s", self.namespace, key, e)
+
+    async def delete(self, key: str):
+        self.local.delete(key)
+        if self.backend is not None:
+            await self.backend.delete(self._key(key))
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Optional[Any]]],
+        min_ttl: float = 0.0,
+    ) -> Optional[Any]:
+        """
+        Возвращает значение из кэша или загружает его через loader. None не кэшируется.
+        С min_ttl запись, которая истечёт раньше, загружается заново.
+        """
+        value = await self.get(key, min_ttl)
+        if value is not None:
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except LoadCancelled:
+                # Отменён вызов, который загружал значение, а не этот: загружаем заново
+                return await self.get_or_load(key, loader, min_ttl)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+            if value is not None:
+                await self.set(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            # Отмена одного вызова не должна отменять остальных ожидающих: они загрузят значение сами
+            future.set_exception(LoadCancelled(f"{self.namespace}:{key}"))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; помечаем его полученным, если их нет
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self.local),
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'evictions': self.local.evictions,
+            'expirations': self.local.expirations,
+            'errors': self.errors,
+        }
@@ -0,0 +1,81 @@
+# circuit.py
+
+import logging
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса.
+
+    После failure_threshold ошибок подряд переходит в состояние open и reset_timeout
+    секунд отклоняет вызовы сразу. Затем пропускает один пробный вызов (half_open):
+    успех закрывает предохранитель, ошибка снова открывает его.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started: Optional[float] = None
+
+        self.rejected = 0
+        self.trips = 0
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning("Предохранитель %s: %s -> %s", self.name, self.state, state)
+            self.state = state
+
+    def allow(self) -> bool:
+        """
+        Можно ли выполнить вызов сейчас.
+        """
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            # Пробный вызов мог быть отменён, не сообщив результат: через reset_timeout пускаем следующий
+            now = time.monotonic()
+            if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        """
+        Вызов, пропущенный allow(), не состоялся: в half_open следующий вызов снова может стать пробным.
+        """
+        self._probe_started = None
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_started = None
+        self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_started = None
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,99 @@
+# cities.py
+
+import logging
+from typing import List, Optional, Tuple
+
+from cache import TwoTierCache
+from citylist import CityIndex
+from config import settings
+from database import City, Repository
+from ratelimit import Priority
+from weather import CityNotFound, WeatherError, lookup_city
+
+logger = logging.getLogger(__name__)
+
+def normalize_city(text: str) -> str:
+    """
+    Приводит пользовательский ввод к ключу-синониму: регистр, пробелы, «ё».
+    """
+    return ' '.join(text.split()).casefold().replace('ё', 'е')
+
+class CityResolver:
+    """
+    Сопоставляет произвольное название города с идентификатором OpenWeather.
+
+    Результаты хранятся в таблицах cities и city_aliases, поэтому каждое новое
+    написание города запрашивается у OpenWeather один раз. Поверх таблиц —
+    кэш в памяти, в котором одновременные запросы одного названия сводятся в один.
+    Названия, однозначно найденные в списке городов OpenWeather (index), — в том числе
+    выбранные в инлайн-подсказках «Название, RU» — сопоставляются без запроса к API.
+    """
+    def __init__(self, repo: Repository, index: Optional[CityIndex] = None):
+        self.repo = repo
+        self.index = index
+        self.cache = TwoTierCache('city', ttl=settings.CITY_CACHE_TTL, local_size=settings.CITY_CACHE_SIZE)
+        # Названия, которых нет в OpenWeather: опечатки не должны каждый раз уходить в API
+        self.missing = TwoTierCache('city_missing', ttl=settings.WEATHER_NEGATIVE_TTL, local_size=settings.CITY_CACHE_SIZE)
+
+    async def resolve(self, text: str, priority: Priority = Priority.INTERACTIVE) -> Optional[City]:
+        """
+        Возвращает город или None, если такого нет. При недоступности OpenWeather бросает WeatherError.
+        """
+        alias = normalize_city(text)
+        if not alias or await self.missing.get(alias):
+            return None
+        return await self.cache.get_or_load(alias, lambda: self._load(alias, text, priority))
+
+    async def _load(self, alias: str, text: str, priority: Priority) -> Optional[City]:
+        city = await self.repo.city_by_alias(alias)
+        if city is not None:
+            return city
+
+        entry = self.index.lookup(text) if self.index is not None else None
+        if entry is not None:
+            city = City(entry.id, entry.name)
+            await self.repo.save_city(city, entry.country or None, None, None, (alias, normalize_city(city.name)))
+            logger.info("Город «%s» сопоставлен по списку городов с %s (id %s).", text, city.name, city.id)
+            return city
+
+        try:
+            data = await lookup_city(text.strip(), priority)
+        except CityNotFound:
+            await self.missing.set(alias, True)
+            return None
+        if 'id' not in data:
+            return None
+
+        city = City(data['id'], data.get('name') or text.strip())
+        coord = data.get('coord', {})
+        await self.repo.save_city(
+            city,
+            data.get('sys', {}).get('country'),
+            coord.get('lat'),
+            coord.get('lon'),
+            (alias, normalize_city(city.name)),
+        )
+        if self.index is not None:
+            self.index.add(city.id, city.name, data.get('sys', {}).get('country'))
+        logger.info("Город «%s» сопоставлен с %s (id %s).", text, city.name, city.id)
+        return city
+
+    async def backfill(self):
+        """
+        Проставляет city_id подпискам и избранным городам, сохранённым до появления справочника.
+        """
+        names = await self.repo.unresolved_city_names()
+        resolved: List[Tuple[str, int]] = []
+        for name in names:
+            try:
+                city = await self.resolve(name, Priority.SCHEDULED)
+            except WeatherError as e:
+                logger.error("Миграция городов прервана: %s", e)
+                break
+            if city is None:
+                logger.warning("Не удалось сопоставить город «%s» при миграции.", name)
+                continue
+            resolved.append((name, city.id))
+        await self.repo.set_city_ids(resolved)
+        if names:
+            logger.info("Сопоставлено %s из %s сохранённых названий городов.", len(resolved), len(names))
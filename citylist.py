@@ -0,0 +1,178 @@
+# citylist.py
+
+import gzip
+import json
+import logging
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько ключей подряд просматривается для одного префикса: короткий префикс
+# («с», «sa») совпадает с десятками тысяч городов, а время ответа должно быть постоянным
+SCAN_LIMIT = 300
+
+# Транслитерация запроса: названия в списке OpenWeather латиницей, пользователи пишут кириллицей.
+# Применяется до удаления диакритики, иначе «й» успевает стать «и»
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+
+class CityEntry(NamedTuple):
+    id: int
+    name: str
+    country: str  # код страны ISO 3166, пустой, если неизвестен
+
+    def label(self) -> str:
+        """
+        Название с кодом страны: так OpenWeather и справочник отличают одноимённые города.
+        """
+        return f"{self.name}, {self.country}" if self.country else self.name
+
+def _casefold(text: str) -> str:
+    return ' '.join(text.split()).casefold().replace('ё', 'е')
+
+def _strip_marks(text: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def fold_name(text: str) -> str:
+    """
+    Ключ индекса: без регистра, лишних пробелов и диакритики, «ё» и «й» как «е» и «и».
+    """
+    return _strip_marks(_casefold(text))
+
+def _prefixes(query: str) -> List[str]:
+    """
+    Префиксы для поиска: сам запрос и его латинские написания. Начальная «е»
+    пишется в списке OpenWeather и как «e», и как «ye» (Yekaterinburg).
+    """
+    text = _casefold(query)
+    folded = _strip_marks(text)
+    if not folded:
+        return []
+    prefixes = [folded]
+    latin = _strip_marks(text.translate(_TRANSLIT))
+    if latin != folded:
+        prefixes.append(latin)
+        if text.startswith('е'):
+            prefixes.append('y' + latin)
+    return prefixes
+
+class CityIndex:
+    """
+    Поиск городов по началу названия без обращения к сети.
+
+    Ключи хранятся отсортированным списком, поля городов — в параллельных
+    массивах; префикс находится двоичным поиском, и просматривается не больше
+    SCAN_LIMIT ключей. Города, которые уже есть в справочнике бота (с русскими
+    названиями), ранжируются выше остальных городов списка OpenWeather.
+    """
+    def __init__(self):
+        self._keys: List[str] = []
+        self._ids = array('q')
+        self._names: List[str] = []
+        self._countries: List[str] = []
+        self._known = bytearray()  # 1 — город есть в справочнике бота
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def read_file(path: str) -> List[Tuple[int, str, str]]:
+        """
+        Читает список городов OpenWeather (city.list.json или city.list.json.gz).
+        """
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        return [(city['id'], city['name'], city.get('country') or '') for city in data if city.get('name')]
+
+    def build(self, cities: Iterable[Tuple[int, str, str]], known: Iterable[Tuple[int, str, str]] = ()):
+        """
+        Строит индекс заново из списка OpenWeather и городов справочника бота.
+        Тяжёлая часть не трогает текущий индекс, поэтому её можно выполнять в отдельном потоке.
+        """
+        rows = [(fold_name(name), 0, city_id, name, country) for city_id, name, country in cities]
+        rows.extend((fold_name(name), 1, city_id, name, country or '') for city_id, name, country in known)
+        rows = [row for row in rows if row[0]]
+        rows.sort(key=lambda row: (row[0], -row[1]))
+        keys = [row[0] for row in rows]
+        ids = array('q', (row[2] for row in rows))
+        names = [row[3] for row in rows]
+        countries = [sys.intern(row[4]) for row in rows]
+        known_flags = bytearray(row[1] for row in rows)
+        self._keys, self._ids, self._names, self._countries, self._known = keys, ids, names, countries, known_flags
+
+    def add(self, city_id: int, name: str, country: Optional[str] = None):
+        """
+        Добавляет город справочника, сопоставленный после построения индекса.
+        """
+        key = fold_name(name)
+        if not key:
+            return
+        position = bisect_left(self._keys, key)
+        end = position
+        while end < len(self._keys) and self._keys[end] == key:
+            if self._ids[end] == city_id and self._known[end]:
+                return
+            end += 1
+        self._keys.insert(position, key)
+        self._ids.insert(position, city_id)
+        self._names.insert(position, name)
+        self._countries.insert(position, sys.intern(country or ''))
+        self._known.insert(position, 1)
+
+    def _entry(self, position: int) -> CityEntry:
+        return CityEntry(self._ids[position], self._names[position], self._countries[position])
+
+    def search(self, query: str, limit: int = 10, exclude: Iterable[int] = ()) -> List[CityEntry]:
+        """
+        Города, названия которых начинаются с query (на кириллице или латинице).
+
+        Сначала города справочника бота, затем точные совпадения, затем более короткие названия.
+        """
+        skip = set(exclude)
+        found: Dict[int, Tuple[Tuple[int, int, int, str], int]] = {}
+        for prefix in _prefixes(query):
+            start = bisect_left(self._keys, prefix)
+            for position in range(start, min(start + SCAN_LIMIT, len(self._keys))):
+                key = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                city_id = self._ids[position]
+                if city_id in skip:
+                    continue
+                rank = (1 - self._known[position], key != prefix, len(key), key)
+                best = found.get(city_id)
+                if best is None or rank < best[0]:
+                    found[city_id] = (rank, position)
+        return [self._entry(position) for _, position in sorted(found.values())[:limit]]
+
+    def lookup(self, text: str) -> Optional[CityEntry]:
+        """
+        Город по точному названию, в том числе в виде «Название, RU».
+        None, если такого нет или названию соответствует несколько разных городов.
+        """
+        name, country = text, ''
+        if ',' in text:
+            name, country = text.rsplit(',', 1)
+            country = country.strip().upper()
+        key = fold_name(name)
+        if not key:
+            return None
+        matches: Dict[int, int] = {}
+        position = bisect_left(self._keys, key)
+        while position < len(self._keys) and self._keys[position] == key:
+            if not country or self._countries[position] == country:
+                matches.setdefault(self._ids[position], position)
+            position += 1
+        if len(matches) != 1:
+            return None
+        return self._entry(next(iter(matches.values())))
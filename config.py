@@ -1,11 +1,216 @@
 # config.py
 
-from pydantic import BaseSettings
+from typing import Optional
+from pydantic import BaseSettings, root_validator, validator
 
 class Settings(BaseSettings):
     TELEGRAM_TOKEN: str
     WEATHER_API_KEY: str
     DATABASE_URL: str
+    # Свой адрес Bot API (локальный сервер Bot API, заглушка в нагрузочных тестах)
+    TELEGRAM_API_URL: Optional[str] = None
+
+    # Пул соединений Postgres
+    DB_POOL_MIN_SIZE: int = 2
+    DB_POOL_MAX_SIZE: int = 20
+    DB_STATEMENT_CACHE_SIZE: int = 1024  # подготовленных операторов на соединение
+    DB_COMMAND_TIMEOUT: float = 10.0
+
+    # Приём апдейтов: 'polling' или 'webhook' (встроенный aiohttp-сервер)
+    BOT_MODE: str = 'polling'
+    WEBHOOK_URL: Optional[str] = None  # внешний адрес, например https://bot.example.com
+    WEBHOOK_PATH: str = '/webhook'
+    WEBHOOK_SECRET: Optional[str] = None
+    WEBHOOK_HOST: str = '0.0.0.0'
+    WEBHOOK_PORT: int = 8080
+    WEBHOOK_MAX_CONCURRENCY: int = 64
+    WEBHOOK_MAX_PENDING: int = 1000
+
+    # Логи: stdout и файл с ротацией; с LOG_QUEUE запись идёт в отдельном потоке
+    LOG_LEVEL: str = 'INFO'
+    LOG_FILE: Optional[str] = 'bot.log'
+    LOG_MAX_BYTES: int = 1_000_000
+    LOG_BACKUP_COUNT: int = 5
+    LOG_QUEUE: bool = True
+    # Не больше LOG_SAMPLE_BURST записей с одним шаблоном за LOG_SAMPLE_INTERVAL секунд (0 — без ограничения)
+    LOG_SAMPLE_BURST: int = 20
+    LOG_SAMPLE_INTERVAL: float = 60.0
+
+    # Метрики Prometheus: /metrics на отдельном сервере в обоих режимах; порт не должен быть доступен извне
+    METRICS_ENABLED: bool = True
+    METRICS_HOST: str = '0.0.0.0'
+    METRICS_PORT: int = 9100
+
+    # Хранилище состояний диалогов: 'postgres' (общее для реплик) или 'memory'
+    FSM_STORAGE: str = 'postgres'
+    FSM_TTL: int = 86400  # диалог, не менявшийся дольше, забывается
+    # Сколько секунд прочитанное состояние берётся из памяти. Запись на другой реплике этот кэш
+    # не сбрасывает, поэтому по умолчанию он включён (2 с) только для одной реплики в режиме polling,
+    # а при SCHEDULER_MODE=coordinated или BOT_MODE=webhook выключен (0)
+    FSM_LOCAL_TTL: Optional[float] = None
+    FSM_LOCAL_SIZE: int = 10_000
+    FSM_PURGE_MINUTES: int = 10
+
+    # Параллельность плановой рассылки
+    WEATHER_FETCH_CONCURRENCY: int = 10
+    SUBSCRIPTION_RESYNC_MINUTES: int = 10
+
+    # Плановая рассылка идёт через таблицу deliveries: 'local' ставит в неё подписки из индекса
+    # в памяти (одна реплика), 'coordinated' — из таблицы users (несколько реплик делят слоты)
+    SCHEDULER_MODE: str = 'local'
+    REPLICA_ID: Optional[str] = None  # по умолчанию hostname:pid
+    DELIVERY_CLAIM_BATCH: int = 500
+    DELIVERY_CLAIM_LEASE: float = 300.0  # секунд; после этого захват упавшей реплики забирают другие
+    DELIVERY_MAX_INFLIGHT_BATCHES: int = 2
+    DELIVERY_GRACE_MINUTES: int = 30  # слоты не старше этого досылаются после простоя или опоздания тика
+    DELIVERY_STATUS_FLUSH_SECONDS: float = 1.0
+    DELIVERY_STATUS_FLUSH_SIZE: int = 1000
+    DELIVERY_RETENTION_DAYS: int = 7
+    # Текст плановой рассылки: 'forecast' — прогноз на сутки, 'summary' — краткая сводка текущей погоды
+    # (города загружаются пачками через /group, один вызов на GROUP_BATCH_SIZE городов)
+    SCHEDULED_FORMAT: str = 'forecast'
+
+    # Кэш: локальный LRU перед общим уровнем ('postgres' или 'memory'), TTL по типам данных
+    CACHE_BACKEND: str = 'postgres'
+    CACHE_LOCAL_SIZE: int = 10_000
+    CACHE_PURGE_MINUTES: int = 10
+    WEATHER_CACHE_TTL: int = 1800
+    WEATHER_STALE_TTL: int = 6 * 3600
+    WEATHER_NEGATIVE_TTL: int = 300
+    CONDITIONS_CACHE_TTL: int = 600  # текущая погода; OpenWeather обновляет её примерно раз в 10 минут
+    CITY_CACHE_TTL: int = 86400
+    CITY_CACHE_SIZE: int = 50_000
+    RENDER_CACHE_SIZE: int = 10_000
+    SUBSCRIPTION_CACHE_SIZE: int = 50_000  # пользователей со списком подписок в памяти
+    SUBSCRIPTION_CACHE_TTL: int = 600
+    FREQUENT_CITIES_CACHE_SIZE: int = 50_000  # пользователей с частыми городами в памяти (подсказки)
+    FREQUENT_CITIES_CACHE_TTL: int = 600
+
+    # Подсказки городов в инлайн-режиме из списка городов OpenWeather
+    # (http://bulk.openweathermap.org/sample/city.list.json.gz); без файла — только справочник бота
+    CITY_LIST_PATH: Optional[str] = 'city.list.json.gz'
+    INLINE_RESULTS: int = 10
+    INLINE_CACHE_TIME: int = 60  # секунд, сколько Telegram хранит ответ на один запрос пользователя
+
+    # Отложенная запись счётчиков выбора городов (user_cities)
+    CITY_USE_FLUSH_SECONDS: float = 5.0
+    CITY_USE_FLUSH_SIZE: int = 500
+
+    # Упреждающая загрузка прогнозов перед слотами рассылки
+    PREFETCH_ENABLED: bool = True
+    PREFETCH_WINDOW_MINUTES: int = 10
+    # При SCHEDULED_FORMAT=summary: текущая погода живёт в кэше меньше прогноза, поэтому греется ближе к слоту
+    PREFETCH_CONDITIONS_WINDOW_MINUTES: int = 3
+
+    # Ограничение входящих апдейтов: на пользователя (в секунду, с запасом burst) и на весь бот
+    RATE_LIMIT_USER_RATE: float = 0.5
+    RATE_LIMIT_USER_BURST: float = 5.0
+    RATE_LIMIT_GLOBAL_RATE: float = 200.0
+    RATE_LIMIT_MAX_USERS: int = 100_000
+
+    # Очередь отправки сообщений Telegram
+    SENDER_WORKERS: int = 8
+    SEND_GLOBAL_RATE: float = 25.0  # сообщений в секунду на реплику (лимит Telegram ~30 на весь бот)
+    SEND_CHAT_RATE: float = 1.0  # сообщений в секунду в один чат
+    SEND_CHAT_BURST: float = 3.0
+    SEND_MAX_RETRIES: int = 5
+
+    # HTTP-клиент OpenWeather
+    OPENWEATHER_BASE_URL: str = "https://api.openweathermap.org/data/2.5"
+    HTTP_POOL_SIZE: int = 100
+    HTTP_POOL_SIZE_PER_HOST: int = 50
+    HTTP_KEEPALIVE_TIMEOUT: float = 30.0
+    HTTP_DNS_CACHE_TTL: int = 300
+    HTTP_TIMEOUT: float = 10.0
+    HTTP_CONNECT_TIMEOUT: float = 3.0
+    # Запросы текущей погоды копятся GROUP_BATCH_WINDOW секунд и уходят в /group по GROUP_BATCH_SIZE id
+    GROUP_BATCH_WINDOW: float = 0.05
+    GROUP_BATCH_SIZE: int = 20
+    # Сколько /forecast ждёт текущую погоду, чтобы дописать её над уже отправленными кнопками
+    QUICK_VIEW_TIMEOUT: float = 5.0
+
+    # Квота вызовов OpenWeather и доля, зарезервированная для интерактивных запросов.
+    # Бюджет считается в каждом процессе отдельно: при нескольких репликах делите квоту ключа на их число
+    WEATHER_CALLS_PER_MINUTE: int = 60
+    WEATHER_CALLS_PER_DAY: int = 30_000
+    WEATHER_INTERACTIVE_RESERVE: float = 0.2
+    # Сколько секунд запрос каждого приоритета может ждать квоту, прежде чем отдать кэш
+    WEATHER_INTERACTIVE_MAX_WAIT: float = 3.0
+    WEATHER_SCHEDULED_MAX_WAIT: float = 30.0
+    WEATHER_PREFETCH_MAX_WAIT: float = 5.0
+
+    # Предохранитель OpenWeather: сколько ошибок подряд открывают его и на сколько секунд
+    WEATHER_BREAKER_THRESHOLD: int = 5
+    WEATHER_BREAKER_RESET: float = 30.0
+
+    @validator('BOT_MODE')
+    def check_bot_mode(cls, value):
+        if value not in ('polling', 'webhook'):
+            raise ValueError("BOT_MODE должен быть 'polling' или 'webhook'")
+        return value
+
+    @validator('SCHEDULER_MODE')
+    def check_scheduler_mode(cls, value):
+        if value not in ('local', 'coordinated'):
+            raise ValueError("SCHEDULER_MODE должен быть 'local' или 'coordinated'")
+        return value
+
+    @validator('SCHEDULED_FORMAT')
+    def check_scheduled_format(cls, value):
+        if value not in ('forecast', 'summary'):
+            raise ValueError("SCHEDULED_FORMAT должен быть 'forecast' или 'summary'")
+        return value
+
+    @validator('GROUP_BATCH_SIZE')
+    def check_group_batch_size(cls, value):
+        # Больше 20 id за вызов OpenWeather не принимает
+        if not 1 <= value <= 20:
+            raise ValueError('GROUP_BATCH_SIZE должен быть от 1 до 20')
+        return value
+
+    @validator('DELIVERY_GRACE_MINUTES')
+    def check_delivery_grace(cls, value):
+        if not 0 <= value < 24 * 60:
+            raise ValueError('DELIVERY_GRACE_MINUTES должен быть от 0 до 1439')
+        return value
+
+    @validator('FSM_STORAGE')
+    def check_fsm_storage(cls, value):
+        if value not in ('postgres', 'memory'):
+            raise ValueError("FSM_STORAGE должен быть 'postgres' или 'memory'")
+        return value
+
+    @validator('CACHE_BACKEND')
+    def check_cache_backend(cls, value):
+        if value not in ('postgres', 'memory'):
+            raise ValueError("CACHE_BACKEND должен быть 'postgres' или 'memory'")
+        return value
+
+    @validator('PREFETCH_WINDOW_MINUTES')
+    def check_prefetch_window(cls, value, values):
+        if not 5 <= value <= 15:
+            raise ValueError('PREFETCH_WINDOW_MINUTES должен быть от 5 до 15')
+        ttl = values.get('WEATHER_CACHE_TTL')
+        if ttl is not None and value * 60 >= ttl:
+            raise ValueError('PREFETCH_WINDOW_MINUTES должен быть меньше WEATHER_CACHE_TTL')
+        return value
+
+    @validator('PREFETCH_CONDITIONS_WINDOW_MINUTES')
+    def check_prefetch_conditions_window(cls, value, values):
+        if not 1 <= value <= 15:
+            raise ValueError('PREFETCH_CONDITIONS_WINDOW_MINUTES должен быть от 1 до 15')
+        # Сводка, прогретая в начале окна, должна дожить до конца рассылки крупного слота
+        ttl = values.get('CONDITIONS_CACHE_TTL')
+        if values.get('SCHEDULED_FORMAT') == 'summary' and ttl is not None and value * 60 * 2 > ttl:
+            raise ValueError('PREFETCH_CONDITIONS_WINDOW_MINUTES должен быть не больше половины CONDITIONS_CACHE_TTL')
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def default_fsm_local_ttl(cls, values):
+        if values.get('FSM_LOCAL_TTL') is None:
+            shared = values.get('SCHEDULER_MODE') == 'coordinated' or values.get('BOT_MODE') == 'webhook'
+            values['FSM_LOCAL_TTL'] = 0.0 if shared else 2.0
+        return values
 
     class Config:
         env_file = ".env"
@@ -1,62 +1,465 @@
 # database.py
 
+import asyncio
 import asyncpg
 import logging
+import time
+from datetime import time as dt_time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from cache import LRUCache
 from config import settings
+from metrics import DB_QUERY_SECONDS
+from migrations import migrate
 
 logger = logging.getLogger(__name__)
 
+class City(NamedTuple):
+    id: int
+    name: str
+
+class UserSubscription(NamedTuple):
+    id: int
+    city: str
+    notification_time: dt_time
+
+class SubscriptionRecord(NamedTuple):
+    id: int
+    user_id: int
+    city_id: Optional[int]  # None у старых записей, ещё не сопоставленных со справочником
+    city: str
+    notification_time: dt_time
+
+# Запросы задаются константами: asyncpg готовит каждый текст запроса один раз на
+# соединение и дальше берёт подготовленный оператор из кэша (DB_STATEMENT_CACHE_SIZE)
+INSERT_SUBSCRIPTION = '''
+    INSERT INTO users (user_id, city, city_id, notification_time)
+    VALUES ($1, $2, $3, $4)
+    RETURNING id
+'''
+SELECT_USER_SUBSCRIPTIONS = '''
+    SELECT id, city, notification_time FROM users
+    WHERE user_id = $1
+    ORDER BY notification_time
+'''
+SELECT_SUBSCRIPTION_OWNED = '''
+    SELECT EXISTS(SELECT 1 FROM users WHERE id = $1 AND user_id = $2)
+'''
+UPDATE_SUBSCRIPTION = '''
+    UPDATE users
+    SET city = $3, city_id = $4, notification_time = $5
+    WHERE id = $1 AND user_id = $2
+    RETURNING id
+'''
+DELETE_SUBSCRIPTION = '''
+    DELETE FROM users WHERE id = $1 AND user_id = $2
+    RETURNING id
+'''
+DELETE_USER_SUBSCRIPTIONS = '''
+    DELETE FROM users WHERE user_id = $1
+'''
+SELECT_ALL_SUBSCRIPTIONS = '''
+    SELECT id, user_id, city_id, city, notification_time FROM users
+'''
+# Самые частые города пользователя и, отдельно, города с ещё не записанными
+# выборами: их счётчики складываются с буфером в памяти
+SELECT_FAVORITE_CITIES = '''
+    (SELECT city, frequency FROM user_cities
+     WHERE user_id = $1
+     ORDER BY frequency DESC
+     LIMIT $2)
+    UNION
+    (SELECT city, frequency FROM user_cities
+     WHERE user_id = $1 AND city = ANY($3::text[]))
+'''
+UPSERT_CITY_USES = '''
+    INSERT INTO user_cities (user_id, city, city_id, frequency)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::bigint[], $4::int[])
+    ON CONFLICT (user_id, city) DO UPDATE
+    SET frequency = user_cities.frequency + EXCLUDED.frequency, city_id = EXCLUDED.city_id
+'''
+SELECT_FREQUENT_CITIES = '''
+    SELECT city_id, city, frequency FROM user_cities
+    WHERE user_id = $1 AND city_id IS NOT NULL
+    ORDER BY frequency DESC
+    LIMIT $2
+'''
+SELECT_CITY_FREQUENCIES = '''
+    SELECT city_id, city, frequency FROM user_cities
+    WHERE user_id = $1 AND city_id = ANY($2::bigint[])
+'''
+SELECT_CITY_BY_ALIAS = '''
+    SELECT c.id, c.name FROM city_aliases a
+    JOIN cities c ON c.id = a.city_id
+    WHERE a.alias = $1
+'''
+INSERT_CITY = '''
+    INSERT INTO cities (id, name, country, lat, lon)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (id) DO NOTHING
+'''
+INSERT_CITY_ALIAS = '''
+    INSERT INTO city_aliases (alias, city_id)
+    VALUES ($1, $2)
+    ON CONFLICT (alias) DO NOTHING
+'''
+SELECT_CITIES = '''
+    SELECT id, name, country FROM cities
+'''
+SELECT_UNRESOLVED_CITIES = '''
+    SELECT city FROM users WHERE city_id IS NULL
+    UNION
+    SELECT city FROM user_cities WHERE city_id IS NULL
+'''
+UPDATE_SUBSCRIPTION_CITY_IDS = '''
+    UPDATE users AS u SET city_id = r.city_id
+    FROM unnest($1::text[], $2::bigint[]) AS r (city, city_id)
+    WHERE u.city = r.city AND u.city_id IS NULL
+'''
+UPDATE_FAVORITE_CITY_IDS = '''
+    UPDATE user_cities AS u SET city_id = r.city_id
+    FROM unnest($1::text[], $2::bigint[]) AS r (city, city_id)
+    WHERE u.city = r.city AND u.city_id IS NULL
+'''
+
+class QueryStats:
+    """
+    Число вызовов и задержка каждого запроса репозитория.
+    """
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}  # имя -> [вызовы, суммарное время, максимум]
+
+    def record(self, name: str, elapsed: float):
+        DB_QUERY_SECONDS.labels(name).observe(elapsed)
+        stats = self._stats.get(name)
+        if stats is None:
+            self._stats[name] = [1, elapsed, elapsed]
+            return
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                'calls': int(calls),
+                'avg_ms': round(total / calls * 1000, 2),
+                'max_ms': round(maximum * 1000, 2),
+            }
+            for name, (calls, total, maximum) in self._stats.items()
+        }
+
+class Repository:
+    """
+    Запросы к таблицам подписок, избранных городов и справочника городов.
+
+    Проверка владельца встроена в сами UPDATE/DELETE (WHERE id = $1 AND user_id = $2),
+    поэтому отдельный запрос на проверку не нужен.
+
+    Списки подписок пользователей кэшируются в LRU: заполняются при чтении и
+    обновляются на месте при изменениях через репозиторий. Изменения с других
+    реплик становятся видны не позже чем через SUBSCRIPTION_CACHE_TTL.
+
+    Выборы городов копятся в памяти и записываются в user_cities одним запросом
+    (отложенная запись); чтение избранного складывает таблицу с буфером и
+    с пачкой, запись которой ещё не завершилась.
+    """
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+        self.stats = QueryStats()
+        self._subscriptions = LRUCache(settings.SUBSCRIPTION_CACHE_SIZE)
+        self.subscription_hits = 0
+        self.subscription_misses = 0
+        # id пользователя -> название города -> [число выборов, id города]
+        self._city_uses: Dict[int, Dict[str, List[int]]] = {}
+        self._city_uses_pending = 0
+        self._city_uses_full = asyncio.Event()
+        # Пачки, которые сейчас записываются: до фиксации их нет ни в буфере, ни в таблице
+        self._city_uses_inflight: List[Dict[int, Dict[str, List[int]]]] = []
+        # Частые города для подсказок: строки таблицы без буфера, сбрасываются при записи буфера
+        self._frequent = LRUCache(settings.FREQUENT_CITIES_CACHE_SIZE)
+
+    async def _call(self, name: str, method: str, query: str, *args) -> Any:
+        started = time.perf_counter()
+        try:
+            return await getattr(self.pool, method)(query, *args)
+        finally:
+            self.stats.record(name, time.perf_counter() - started)
+
+    # Подписки
+
+    def _cached_subscriptions(self, user_id: int) -> Optional[Tuple[UserSubscription, ...]]:
+        cached = self._subscriptions.get(str(user_id))
+        if cached is None:
+            self.subscription_misses += 1
+        else:
+            self.subscription_hits += 1
+        return cached
+
+    def _update_cached(self, user_id: int, change):
+        """
+        Применяет change к закэшированному списку пользователя, если он есть в кэше.
+        """
+        key = str(user_id)
+        cached = self._subscriptions.get(key)
+        if cached is not None:
+            updated = sorted(change(cached), key=lambda subscription: subscription.notification_time)
+            self._subscriptions.set(key, tuple(updated), settings.SUBSCRIPTION_CACHE_TTL)
+
+    async def add_subscription(self, user_id: int, city: City, notification_time: dt_time) -> int:
+        subscription_id = await self._call('add_subscription', 'fetchval', INSERT_SUBSCRIPTION,
+                                           user_id, city.name, city.id, notification_time)
+        added = UserSubscription(subscription_id, city.name, notification_time)
+        self._update_cached(user_id, lambda subscriptions: subscriptions + (added,))
+        return subscription_id
+
+    async def user_subscriptions(self, user_id: int) -> List[UserSubscription]:
+        cached = self._cached_subscriptions(user_id)
+        if cached is not None:
+            return list(cached)
+        rows = await self._call('user_subscriptions', 'fetch', SELECT_USER_SUBSCRIPTIONS, user_id)
+        subscriptions = tuple(UserSubscription(row['id'], row['city'], row['notification_time']) for row in rows)
+        self._subscriptions.set(str(user_id), subscriptions, settings.SUBSCRIPTION_CACHE_TTL)
+        return list(subscriptions)
+
+    async def owns_subscription(self, subscription_id: int, user_id: int) -> bool:
+        cached = self._cached_subscriptions(user_id)
+        if cached is not None:
+            return any(subscription.id == subscription_id for subscription in cached)
+        return await self._call('owns_subscription', 'fetchval', SELECT_SUBSCRIPTION_OWNED, subscription_id, user_id)
+
+    async def update_subscription(self, subscription_id: int, user_id: int, city: City, notification_time: dt_time) -> bool:
+        """
+        Меняет город и время подписки. False, если подписки нет или она чужая.
+        """
+        updated = await self._call('update_subscription', 'fetchval', UPDATE_SUBSCRIPTION,
+                                   subscription_id, user_id, city.name, city.id, notification_time)
+        if updated is None:
+            # Кэш мог устареть (подписку удалили с другой реплики)
+            self._subscriptions.delete(str(user_id))
+            return False
+        changed = UserSubscription(subscription_id, city.name, notification_time)
+        self._update_cached(user_id, lambda subscriptions: tuple(
+            changed if subscription.id == subscription_id else subscription for subscription in subscriptions
+        ))
+        return True
+
+    async def delete_subscription(self, subscription_id: int, user_id: int) -> bool:
+        """
+        Удаляет подписку. False, если подписки нет или она чужая.
+        """
+        deleted = await self._call('delete_subscription', 'fetchval', DELETE_SUBSCRIPTION, subscription_id, user_id)
+        self._update_cached(user_id, lambda subscriptions: tuple(
+            subscription for subscription in subscriptions if subscription.id != subscription_id
+        ))
+        return deleted is not None
+
+    async def delete_user_subscriptions(self, user_id: int) -> int:
+        result = await self._call('delete_user_subscriptions', 'execute', DELETE_USER_SUBSCRIPTIONS, user_id)
+        self._subscriptions.set(str(user_id), (), settings.SUBSCRIPTION_CACHE_TTL)
+        return int(result.split()[-1])
+
+    def subscription_cache_stats(self) -> Dict[str, Any]:
+        lookups = self.subscription_hits + self.subscription_misses
+        return {
+            'size': len(self._subscriptions),
+            'hits': self.subscription_hits,
+            'misses': self.subscription_misses,
+            'hit_rate': round(self.subscription_hits / lookups, 3) if lookups else 0.0,
+            'evictions': self._subscriptions.evictions,
+        }
+
+    async def all_subscriptions(self) -> List[SubscriptionRecord]:
+        rows = await self._call('all_subscriptions', 'fetch', SELECT_ALL_SUBSCRIPTIONS)
+        return [
+            SubscriptionRecord(row['id'], row['user_id'], row['city_id'], row['city'], row['notification_time'])
+            for row in rows
+        ]
+
+    # Избранные города
+
+    def _buffered_uses(self, user_id: int) -> Dict[str, List[int]]:
+        """
+        Выборы пользователя, ещё не записанные в таблицу: буфер и записываемые пачки.
+        """
+        merged: Dict[str, List[int]] = {}
+        for uses in (*self._city_uses_inflight, self._city_uses):
+            for name, (count, city_id) in uses.get(user_id, {}).items():
+                use = merged.setdefault(name, [0, city_id])
+                use[0] += count
+                use[1] = city_id
+        return merged
+
+    async def favorite_cities(self, user_id: int, limit: int = 5) -> List[str]:
+        pending = self._buffered_uses(user_id)
+        rows = await self._call('favorite_cities', 'fetch', SELECT_FAVORITE_CITIES, user_id, limit, list(pending))
+        frequencies = {row['city']: row['frequency'] for row in rows}
+        for name, (count, _) in pending.items():
+            frequencies[name] = frequencies.get(name, 0) + count
+        return sorted(frequencies, key=frequencies.get, reverse=True)[:limit]
+
+    async def frequent_cities(self, user_id: int, limit: int = 20) -> List[Tuple[City, int]]:
+        """
+        Города пользователя с числом выборов, по убыванию. Читается на каждую
+        подсказку, поэтому строки таблицы кэшируются, а буфер складывается с ними при чтении.
+        """
+        key = str(user_id)
+        rows = self._frequent.get(key)
+        if rows is None:
+            records = await self._call('frequent_cities', 'fetch', SELECT_FREQUENT_CITIES, user_id, limit)
+            rows = tuple((record['city_id'], record['city'], record['frequency']) for record in records)
+            self._frequent.set(key, rows, settings.FREQUENT_CITIES_CACHE_TTL)
+        buffered = self._buffered_uses(user_id)
+        if len(rows) >= limit:
+            # Город из буфера может быть в таблице за пределами первых limit строк: его счётчик читается отдельно
+            listed = {city_id for city_id, _, _ in rows}
+            missing = list({city_id for _, city_id in buffered.values() if city_id not in listed})
+            if missing:
+                records = await self._call('city_frequencies', 'fetch', SELECT_CITY_FREQUENCIES, user_id, missing)
+                rows += tuple((record['city_id'], record['city'], record['frequency']) for record in records)
+        frequencies: Dict[int, List] = {}
+        for city_id, name, frequency in rows:
+            frequencies.setdefault(city_id, [name, 0])[1] += frequency
+        for name, (count, city_id) in buffered.items():
+            frequencies.setdefault(city_id, [name, 0])[1] += count
+        ranked = sorted(frequencies.items(), key=lambda item: item[1][1], reverse=True)
+        return [(City(city_id, name), frequency) for city_id, (name, frequency) in ranked[:limit]]
+
+    def record_city_use(self, user_id: int, city: City):
+        """
+        Учитывает выбор города пользователем. В базу попадёт при очередном сбросе буфера.
+        """
+        use = self._city_uses.setdefault(user_id, {}).setdefault(city.name, [0, city.id])
+        use[0] += 1
+        use[1] = city.id
+        self._city_uses_pending += 1
+        if self._city_uses_pending >= settings.CITY_USE_FLUSH_SIZE:
+            self._city_uses_full.set()
+
+    async def flush_city_uses(self):
+        """
+        Записывает накопленные выборы городов одним запросом.
+        """
+        self._city_uses_full.clear()
+        if not self._city_uses:
+            return
+        uses, self._city_uses = self._city_uses, {}
+        pending, self._city_uses_pending = self._city_uses_pending, 0
+        rows = [
+            (user_id, name, city_id, count)
+            for user_id, cities in uses.items()
+            for name, (count, city_id) in cities.items()
+        ]
+        self._city_uses_inflight.append(uses)
+        try:
+            await self._call('flush_city_uses', 'execute', UPSERT_CITY_USES, *map(list, zip(*rows)))
+        except BaseException as e:
+            self._city_uses_inflight.remove(uses)
+            # Возвращаем выборы в буфер, сложив с пришедшими за время записи
+            for user_id, cities in uses.items():
+                for name, (count, city_id) in cities.items():
+                    use = self._city_uses.setdefault(user_id, {}).setdefault(name, [0, city_id])
+                    use[0] += count
+            self._city_uses_pending += pending
+            if not isinstance(e, Exception):
+                raise
+            logger.error("Ошибка записи выборов городов (%s шт.): %s", len(rows), e)
+        else:
+            self._city_uses_inflight.remove(uses)
+            # Записанные выборы теперь в таблице: кэш частых городов этих пользователей устарел
+            for user_id in uses:
+                self._frequent.delete(str(user_id))
+
+    async def run_city_use_flusher(self):
+        """
+        Сбрасывает буфер выборов городов раз в CITY_USE_FLUSH_SECONDS или по заполнении.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._city_uses_full.wait(), settings.CITY_USE_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush_city_uses()
+
+    # Справочник городов
+
+    async def city_by_alias(self, alias: str) -> Optional[City]:
+        row = await self._call('city_by_alias', 'fetchrow', SELECT_CITY_BY_ALIAS, alias)
+        return City(row['id'], row['name']) if row else None
+
+    async def save_city(
+        self,
+        city: City,
+        country: Optional[str],
+        lat: Optional[float],
+        lon: Optional[float],
+        aliases: Iterable[str],
+    ):
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(INSERT_CITY, city.id, city.name, country, lat, lon)
+                    await conn.executemany(INSERT_CITY_ALIAS, [(alias, city.id) for alias in aliases])
+        finally:
+            self.stats.record('save_city', time.perf_counter() - started)
+
+    async def all_cities(self) -> List[Tuple[int, str, str]]:
+        rows = await self._call('all_cities', 'fetch', SELECT_CITIES)
+        return [(row['id'], row['name'], row['country'] or '') for row in rows]
+
+    async def unresolved_city_names(self) -> List[str]:
+        rows = await self._call('unresolved_city_names', 'fetch', SELECT_UNRESOLVED_CITIES)
+        return [row['city'] for row in rows]
+
+    async def set_city_ids(self, resolved: List[Tuple[str, int]]):
+        """
+        Проставляет city_id подпискам и избранным городам по названиям: один запрос на таблицу.
+        """
+        if not resolved:
+            return
+        names = [name for name, _ in resolved]
+        city_ids = [city_id for _, city_id in resolved]
+        await self._call('set_subscription_city_ids', 'execute', UPDATE_SUBSCRIPTION_CITY_IDS, names, city_ids)
+        await self._call('set_favorite_city_ids', 'execute', UPDATE_FAVORITE_CITY_IDS, names, city_ids)
+
 class Database:
     def __init__(self):
         self.pool: asyncpg.pool.Pool = None
+        self.repo: Repository = None
 
     async def connect(self):
-        logger.info(f"Подключение к базе данных по адресу: {settings.DATABASE_URL}")
-        self.pool = await asyncpg.create_pool(dsn=settings.DATABASE_URL)
+        logger.info("Подключение к базе данных по адресу: %s", settings.DATABASE_URL)
+        self.pool = await asyncpg.create_pool(
+            dsn=settings.DATABASE_URL,
+            min_size=settings.DB_POOL_MIN_SIZE,
+            max_size=settings.DB_POOL_MAX_SIZE,
+            statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+            command_timeout=settings.DB_COMMAND_TIMEOUT,
+        )
+        self.repo = Repository(self.pool)
         logger.info("Пул соединений с базой данных создан.")
-        await self.create_tables()
-
-    async def create_tables(self):
-        async with self.pool.acquire() as conn:
-            # Создание таблицы users с новым столбцом id
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    city TEXT NOT NULL,
-                    notification_time TIME NOT NULL
-                );
-            ''')
-
-            # Создание таблицы user_cities
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_cities (
-                    user_id BIGINT,
-                    city TEXT,
-                    frequency INT DEFAULT 1,
-                    PRIMARY KEY (user_id, city)
-                );
-            ''')
-
-            # Обновление таблицы users: добавление столбца id, если он не существует
-            await conn.execute('''
-                ALTER TABLE users 
-                ADD COLUMN IF NOT EXISTS id SERIAL;
-            ''')
-
-            # Удаление существующего первичного ключа на user_id, если он существует
-            await conn.execute('''
-                ALTER TABLE users 
-                DROP CONSTRAINT IF EXISTS users_pkey;
-            ''')
-
-            # Установка нового первичного ключа на id
-            await conn.execute('''
-                ALTER TABLE users 
-                ADD PRIMARY KEY (id);
-            ''')
-
-            logger.info("Таблицы базы данных созданы или уже существуют и обновлены.")
+        await self.migrate()
+
+    async def migrate(self):
+        applied = await migrate(self.pool)
+        if applied:
+            logger.info("Применено миграций схемы: %s.", applied)
+        else:
+            logger.info("Схема базы данных актуальна.")
+
+    async def build_indexes(self):
+        """
+        Строит индексы из миграций без блокировки таблиц. Запускается в фоне после старта.
+        """
+        try:
+            applied = await migrate(self.pool, concurrent=True)
+        except Exception as e:
+            logger.error("Ошибка при построении индексов: %s", e)
+            return
+        if applied:
+            logger.info("Построено индексов: %s.", applied)
 
     async def close(self):
         await self.pool.close()
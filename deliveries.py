@@ -0,0 +1,221 @@
+# deliveries.py
+
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import asyncpg
+
+from metrics import DB_QUERY_SECONDS
+from subscriptions import MOSCOW_TZ, Subscription
+
+logger = logging.getLogger(__name__)
+
+class Claim(NamedTuple):
+    slot_at: datetime
+    subscription: Subscription
+
+# Сколько строк удаляется одним запросом при очистке старых записей
+PRUNE_BATCH = 10_000
+
+class DeliveryCoordinator:
+    """
+    Очередь плановой рассылки (outbox) в таблице deliveries.
+
+    Подписки слота ставятся в таблицу одним запросом; повторная постановка ничего
+    не меняет благодаря первичному ключу (subscription_id, slot_at), поэтому
+    подписка доставляется в свой слот не больше раза даже после перезапуска.
+    Подписка, перенесённая на более позднее время, в тот же день приходит и в новый слот.
+    Записи забираются пачками через FOR UPDATE SKIP LOCKED, и реплики обрабатывают
+    непересекающиеся части слота. Захват действует lease секунд и продлевается,
+    пока сообщения ждут в очереди отправки: если реплика упала посреди рассылки,
+    её записи после этого забирает другая.
+
+    Статусы доставленных сообщений копятся в памяти и записываются пачками.
+    """
+    def __init__(
+        self,
+        pool: asyncpg.pool.Pool,
+        batch_size: int,
+        lease: float,
+        replica_id: Optional[str] = None,
+        flush_interval: float = 1.0,
+        flush_size: int = 1000,
+    ):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.lease = lease
+        self.replica_id = replica_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._statuses: Dict[str, List[Claim]] = {'sent': [], 'failed': []}
+        self._full = asyncio.Event()
+
+        self.enqueued = 0
+        self.claimed = 0
+        self.sent = 0
+        self.failed = 0
+
+    async def enqueue(self, slot_at: datetime, subscriptions: Optional[List[Subscription]] = None) -> int:
+        """
+        Ставит в очередь подписки на минуту slot_at (время по Москве).
+
+        Без subscriptions подписки слота берутся из таблицы users: так все реплики
+        ставят один и тот же набор, даже если их индексы в памяти расходятся.
+        """
+        if subscriptions is None:
+            with DB_QUERY_SECONDS.labels('delivery_enqueue').time():
+                result = await self.pool.execute('''
+                    INSERT INTO deliveries (subscription_id, slot_date, slot_at, user_id, city_id, city)
+                    SELECT id, $1, $2, user_id, city_id, city
+                    FROM users
+                    WHERE notification_time = $3
+                    ON CONFLICT DO NOTHING
+                ''', slot_at.date(), slot_at, slot_at.time())
+        elif subscriptions:
+            with DB_QUERY_SECONDS.labels('delivery_enqueue').time():
+                result = await self.pool.execute('''
+                    INSERT INTO deliveries (subscription_id, slot_date, slot_at, user_id, city_id, city)
+                    SELECT subscription_id, $1, $2, user_id, city_id, city
+                    FROM unnest($3::int[], $4::bigint[], $5::bigint[], $6::text[])
+                        AS due (subscription_id, user_id, city_id, city)
+                    ON CONFLICT DO NOTHING
+                ''', slot_at.date(), slot_at,
+                    [subscription.id for subscription in subscriptions],
+                    [subscription.user_id for subscription in subscriptions],
+                    [subscription.city_id for subscription in subscriptions],
+                    [subscription.city for subscription in subscriptions])
+        else:
+            return 0
+        inserted = int(result.split()[-1])
+        self.enqueued += inserted
+        return inserted
+
+    async def claim(self, slot_from: datetime, slot_to: datetime) -> List[Claim]:
+        """
+        Забирает очередную пачку неотправленных записей со слотами в [slot_from, slot_to].
+
+        Записи одного города идут подряд, чтобы пачка требовала меньше загрузок прогнозов.
+        """
+        with DB_QUERY_SECONDS.labels('delivery_claim').time():
+            rows = await self.pool.fetch('''
+                UPDATE deliveries AS d
+                SET status = 'claimed', claimed_by = $3, claimed_at = now()
+                FROM (
+                    SELECT subscription_id, slot_at
+                    FROM deliveries
+                    WHERE slot_at BETWEEN $1 AND $2
+                      AND (status = 'pending'
+                           OR (status = 'claimed' AND claimed_at < now() - make_interval(secs => $4)))
+                    ORDER BY city_id NULLS LAST
+                    LIMIT $5
+                    FOR UPDATE SKIP LOCKED
+                ) AS due
+                WHERE d.subscription_id = due.subscription_id AND d.slot_at = due.slot_at
+                RETURNING d.subscription_id, d.slot_at, d.user_id, d.city_id, d.city
+            ''', slot_from, slot_to, self.replica_id, float(self.lease), self.batch_size)
+        self.claimed += len(rows)
+        return [
+            Claim(row['slot_at'], Subscription(row['subscription_id'], row['user_id'], row['city_id'], row['city']))
+            for row in rows
+        ]
+
+    async def extend(self, claims: Iterable[Claim]):
+        """
+        Продлевает аренду захваченных этой репликой записей, пока их сообщения ждут отправки.
+        """
+        claims = list(claims)
+        with DB_QUERY_SECONDS.labels('delivery_extend').time():
+            await self.pool.execute('''
+                UPDATE deliveries AS d
+                SET claimed_at = now()
+                FROM unnest($1::int[], $2::timestamptz[]) AS held (subscription_id, slot_at)
+                WHERE d.subscription_id = held.subscription_id AND d.slot_at = held.slot_at
+                  AND d.status = 'claimed' AND d.claimed_by = $3
+            ''', [claim.subscription.id for claim in claims], [claim.slot_at for claim in claims], self.replica_id)
+
+    def mark(self, claim: Claim, status: str):
+        """
+        Запоминает итог доставки: status — 'sent' или 'failed'. Записывается при очередном сбросе.
+        """
+        self._statuses[status].append(claim)
+        if self.pending_statuses() >= self.flush_size:
+            self._full.set()
+
+    async def flush(self):
+        """
+        Записывает накопленные статусы: один запрос на каждый статус.
+        """
+        self._full.clear()
+        for status, claims in self._statuses.items():
+            if not claims:
+                continue
+            self._statuses[status] = []
+            try:
+                await self._write_status(claims, status)
+            except BaseException as e:
+                # Записи остаются захваченными; попробуем снова при следующем сбросе
+                self._statuses[status] = claims + self._statuses[status]
+                if not isinstance(e, Exception):
+                    raise
+                logger.error("Ошибка записи статусов рассылки (%s шт.): %s", len(claims), e)
+                continue
+            if status == 'sent':
+                self.sent += len(claims)
+            else:
+                self.failed += len(claims)
+
+    async def _write_status(self, claims: Iterable[Claim], status: str):
+        claims = list(claims)
+        with DB_QUERY_SECONDS.labels('delivery_status').time():
+            await self.pool.execute('''
+                UPDATE deliveries AS d
+                SET status = $3, claimed_by = NULL, sent_at = CASE WHEN $3 = 'sent' THEN now() END
+                FROM unnest($1::int[], $2::timestamptz[]) AS done (subscription_id, slot_at)
+                WHERE d.subscription_id = done.subscription_id AND d.slot_at = done.slot_at
+            ''', [claim.subscription.id for claim in claims], [claim.slot_at for claim in claims], status)
+
+    async def run(self):
+        """
+        Сбрасывает статусы раз в flush_interval секунд или сразу, когда их накопилось flush_size.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def prune(self, retention_days: int) -> int:
+        """
+        Удаляет записи старше retention_days суток порциями, не блокируя таблицу надолго.
+        """
+        before = datetime.now(MOSCOW_TZ).date() - timedelta(days=retention_days)
+        removed = 0
+        while True:
+            result = await self.pool.execute('''
+                DELETE FROM deliveries
+                WHERE ctid IN (
+                    SELECT ctid FROM deliveries WHERE slot_date < $1 LIMIT $2
+                )
+            ''', before, PRUNE_BATCH)
+            count = int(result.split()[-1])
+            removed += count
+            if count < PRUNE_BATCH:
+                return removed
+
+    def pending_statuses(self) -> int:
+        return sum(len(claims) for claims in self._statuses.values())
+
+    def stats(self) -> dict:
+        return {
+            'replica': self.replica_id,
+            'enqueued': self.enqueued,
+            'claimed': self.claimed,
+            'sent': self.sent,
+            'failed': self.failed,
+            'unflushed': self.pending_statuses(),
+        }
@@ -0,0 +1,97 @@
+# forecast.py
+
+import json
+import sys
+from array import array
+from datetime import datetime, timezone
+from typing import Iterator, NamedTuple, Tuple
+
+# 8 прогнозов с шагом 3 часа — ближайшие 24 часа; остальные интервалы ответа не используются
+FORECAST_SLOTS = 8
+
+class Forecast:
+    """
+    Компактный прогноз для кэша: только интервалы и поля, которые показываются
+    пользователю, в массивах вместо вложенных словарей ответа OpenWeather.
+    """
+    __slots__ = ('city_id', 'fetched_at', 'times', 'temps', 'descriptions')
+
+    def __init__(self, city_id: int, fetched_at: int, times: array, temps: array, descriptions: Tuple[str, ...]):
+        self.city_id = city_id
+        self.fetched_at = fetched_at  # момент загрузки, служит версией прогноза
+        self.times = times  # array('q'): unix-время начала интервала, UTC
+        self.temps = temps  # array('d'): температура, °C
+        self.descriptions = descriptions  # описания погоды; одинаковые строки разделяются через intern
+
+    @classmethod
+    def from_api(cls, city_id: int, data: dict, fetched_at: int, slots: int = FORECAST_SLOTS) -> 'Forecast':
+        entries = data.get('list', [])[:slots]
+        return cls(
+            city_id,
+            fetched_at,
+            array('q', (entry['dt'] for entry in entries)),
+            array('d', (entry['main']['temp'] for entry in entries)),
+            tuple(sys.intern(entry['weather'][0]['description']) for entry in entries),
+        )
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def entries(self) -> Iterator[Tuple[str, float, str]]:
+        """
+        Интервалы прогноза: время в формате dt_txt OpenWeather, температура, описание.
+        """
+        for dt, temp, description in zip(self.times, self.temps, self.descriptions):
+            yield datetime.fromtimestamp(dt, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), temp, description
+
+    def dumps(self) -> str:
+        """
+        Сериализация для общего уровня кэша: плоский JSON-массив без имён полей.
+        """
+        return json.dumps(
+            [self.city_id, self.fetched_at, self.times.tolist(), self.temps.tolist(), self.descriptions],
+            ensure_ascii=False,
+            separators=(',', ':'),
+        )
+
+    @classmethod
+    def loads(cls, raw: str) -> 'Forecast':
+        city_id, fetched_at, times, temps, descriptions = json.loads(raw)
+        return cls(
+            city_id,
+            fetched_at,
+            array('q', times),
+            array('d', temps),
+            tuple(sys.intern(description) for description in descriptions),
+        )
+
+class Conditions(NamedTuple):
+    """
+    Текущая погода в городе из ответа /weather или /group.
+    """
+    city_id: int
+    fetched_at: int
+    observed_at: int  # unix-время наблюдения, UTC
+    temp: float
+    feels_like: float
+    description: str
+
+    @classmethod
+    def from_api(cls, data: dict, fetched_at: int) -> 'Conditions':
+        main = data['main']
+        return cls(
+            data['id'],
+            fetched_at,
+            data.get('dt', fetched_at),
+            main['temp'],
+            main.get('feels_like', main['temp']),
+            sys.intern(data['weather'][0]['description']),
+        )
+
+    def dumps(self) -> str:
+        return json.dumps(list(self), ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw: str) -> 'Conditions':
+        city_id, fetched_at, observed_at, temp, feels_like, description = json.loads(raw)
+        return cls(city_id, fetched_at, observed_at, temp, feels_like, sys.intern(description))
@@ -0,0 +1,121 @@
+# fsm_storage.py
+
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import asyncpg
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from cache import LRUCache
+from metrics import DB_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Сколько просроченных записей удаляется одним запросом
+PURGE_BATCH = 10_000
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_states: диалоги переживают перезапуск
+    и продолжаются на любой реплике.
+
+    Состояние и данные ключа читаются одним запросом и кэшируются в памяти на
+    local_ttl секунд, в том числе отсутствие записи: фильтр состояний читает его
+    на каждом апдейте. Запись идёт сразу в базу и обновляет локальный кэш, но не
+    кэши других реплик, поэтому при нескольких репликах local_ttl должен быть 0.
+    Записи без изменений дольше ttl секунд считаются устаревшими.
+    """
+    def __init__(self, pool: asyncpg.pool.Pool, ttl: float, local_ttl: float, local_size: int):
+        self.pool = pool
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self._local = LRUCache(local_size)
+
+        self.local_hits = 0
+        self.reads = 0
+        self.writes = 0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.destiny}"
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        record = self._local.get(key) if self.local_ttl > 0 else None
+        if record is not None:
+            self.local_hits += 1
+            return record
+        self.reads += 1
+        with DB_QUERY_SECONDS.labels('fsm_load').time():
+            row = await self.pool.fetchrow('''
+                SELECT state, data FROM fsm_states
+                WHERE key = $1 AND expires_at > now()
+            ''', key)
+        record = (row['state'], json.loads(row['data'])) if row else (None, {})
+        if self.local_ttl > 0:
+            self._local.set(key, record, self.local_ttl)
+        return record
+
+    async def _store(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        self.writes += 1
+        with DB_QUERY_SECONDS.labels('fsm_store').time():
+            if state is None and not data:
+                await self.pool.execute('DELETE FROM fsm_states WHERE key = $1', key)
+            else:
+                await self.pool.execute('''
+                    INSERT INTO fsm_states (key, state, data, expires_at)
+                    VALUES ($1, $2, $3, now() + make_interval(secs => $4))
+                    ON CONFLICT (key) DO UPDATE
+                    SET state = EXCLUDED.state, data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                ''', key, state, json.dumps(data, ensure_ascii=False), float(self.ttl))
+        if self.local_ttl > 0:
+            self._local.set(key, (state, data), self.local_ttl)
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        _, data = await self._load(storage_key)
+        await self._store(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        state, _ = await self._load(storage_key)
+        await self._store(storage_key, state, data.copy())
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def purge_expired(self) -> int:
+        """
+        Удаляет устаревшие записи порциями, не блокируя таблицу надолго.
+        """
+        removed = 0
+        while True:
+            result = await self.pool.execute('''
+                DELETE FROM fsm_states
+                WHERE key IN (
+                    SELECT key FROM fsm_states WHERE expires_at <= now() LIMIT $1
+                )
+            ''', PURGE_BATCH)
+            count = int(result.split()[-1])
+            removed += count
+            if count < PURGE_BATCH:
+                return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._local),
+            'local_hits': self.local_hits,
+            'reads': self.reads,
+            'writes': self.writes,
+        }
+
+    async def close(self) -> None:
+        # Пул соединений принадлежит Database и закрывается вместе с ней
+        pass
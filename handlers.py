@@ -1,16 +1,26 @@
 # handlers.py
 
-from aiogram import Router
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram import Bot, Router
+from aiogram.types import (
+    Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent,
+)
 from aiogram.filters import CommandStart, Command
 from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from typing import Optional, Dict, Any
-from keyboards import get_commands_keyboard 
-
-import asyncpg
-from weather import get_weather
+from typing import Optional, Dict, Any, List
+from keyboards import get_commands_keyboard
+from cities import City, CityResolver
+from citylist import CityEntry, CityIndex, fold_name
+from config import settings
+from database import Repository
+from sender import MessageSender
+from subscriptions import SubscriptionIndex
+
+from render import render_conditions, render_forecast
+from weather import WeatherError, get_conditions, get_weather
+import asyncio
 import logging
 import re
 
@@ -43,12 +53,26 @@ def parse_time_and_city(input_str: str) -> Optional[Dict[str, Any]]:
             return {'time': time(hour=hours, minute=minutes), 'city': city.strip()}
     return None
 
+async def resolve_city_or_reply(resolver: CityResolver, sender: MessageSender, chat_id: int, name: str) -> Optional[City]:
+    """
+    Сопоставляет название города со справочником; если не получилось, сообщает пользователю причину.
+    """
+    try:
+        city = await resolver.resolve(name)
+    except WeatherError as e:
+        logger.warning("Не удалось сопоставить город %s: %s", name, e)
+        await sender.send(chat_id, "Сервис погоды временно недоступен. Попробуйте позже.")
+        return None
+    if city is None:
+        await sender.send(chat_id, f"Город «{name}» не найден. Проверьте название и попробуйте снова.")
+    return city
 
 # Обработчик команды /start
 @router.message(CommandStart())
-async def send_welcome(message: Message):
-    logger.info(f"Получена команда /start от пользователя {message.from_user.id}")
-    await message.answer(
+async def send_welcome(message: Message, sender: MessageSender):
+    logger.info("Получена команда /start от пользователя %s", message.from_user.id)
+    await sender.send(
+        message.chat.id,
         "Привет! Я бот, который может отправлять прогноз погоды.\n"
         "Используй /set для настройки времени отправки уведомлений о погоде,\n"
         "либо просто отправь название города для получения прогноза.",
@@ -57,8 +81,8 @@ async def send_welcome(message: Message):
 
 # Обработчик команды /help с инлайн-кнопками
 @router.message(Command(commands=['help']))
-async def send_help(message: Message):
-    logger.info(f"Получена команда /help от пользователя {message.from_user.id}")
+async def send_help(message: Message, sender: MessageSender):
+    logger.info("Получена команда /help от пользователя %s", message.from_user.id)
     
     # Создаём инлайн-клавиатуру с кнопками для каждой команды
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -72,11 +96,11 @@ async def send_help(message: Message):
         [InlineKeyboardButton(text="/delete", callback_data=HelpCallback(command_name="delete").pack())],
     ])
     
-    await message.answer("Выберите команду для получения информации:", reply_markup=keyboard)
+    await sender.send(message.chat.id, "Выберите команду для получения информации:", reply_markup=keyboard)
 
 # Обработчик нажатий на кнопки помощи
 @router.callback_query(HelpCallback.filter())
-async def help_command_selected(callback_query: CallbackQuery, callback_data: HelpCallback, db: asyncpg.pool.Pool):
+async def help_command_selected(callback_query: CallbackQuery, callback_data: HelpCallback, sender: MessageSender):
     command = callback_data.command_name
 
     help_texts = {
@@ -94,7 +118,8 @@ async def help_command_selected(callback_query: CallbackQuery, callback_data: He
         ),
         "forecast": (
             "/forecast - Получить прогноз погоды.\n"
-            "Выберите город из списка или отправьте название города для получения прогноза."
+            "Показывает текущую погоду в ваших частых городах. Выберите город из списка "
+            "или отправьте название города для получения прогноза на сутки."
         ),
         "edit": (
             "/edit - Изменить время или город для уведомлений о погоде.\n"
@@ -115,17 +140,18 @@ async def help_command_selected(callback_query: CallbackQuery, callback_data: He
 
     help_text = help_texts.get(command, "Неизвестная команда.")
 
-    await callback_query.message.answer(help_text)
+    await sender.send(callback_query.message.chat.id, help_text)
     await callback_query.answer()
 
 # Обработчик команды /set с аргументами
 @router.message(Command(commands=['set']))
-async def set_notification_time_and_city(message: Message, db: asyncpg.pool.Pool):
-    logger.info(f"Получена команда /set от пользователя {message.from_user.id}: {message.text}")
+async def set_notification_time_and_city(message: Message, repo: Repository, sender: MessageSender, resolver: CityResolver, index: SubscriptionIndex):
+    logger.info("Получена команда /set от пользователя %s: %s", message.from_user.id, message.text)
     user_input = message.text[4:].strip()  # Извлекаем текст после "/set"
 
     if not user_input:
-        await message.answer(
+        await sender.send(
+            message.chat.id,
             "Пожалуйста, используйте команду в формате: `/set HH:MM, Название города` (например, `/set 09:30, Москва`).",
             parse_mode="Markdown"
         )
@@ -135,68 +161,63 @@ async def set_notification_time_and_city(message: Message, db: asyncpg.pool.Pool
     if parsed:
         user_id = message.from_user.id
         notification_time = parsed['time']
-        city = parsed['city']
-        logger.info(f"Добавление нового уведомления для пользователя {user_id}: город {city}, время {notification_time}")
+        city = await resolve_city_or_reply(resolver, sender, message.chat.id, parsed['city'])
+        if city is None:
+            return
+        logger.info("Добавление нового уведомления для пользователя %s: город %s, время %s", user_id, city.name, notification_time)
 
-        await db.execute('''
-            INSERT INTO users (user_id, city, notification_time)
-            VALUES ($1, $2, $3)
-        ''', user_id, city, notification_time)
+        subscription_id = await repo.add_subscription(user_id, city, notification_time)
+        index.add(subscription_id, user_id, city.id, city.name, notification_time)
 
-        await message.answer(
-            f"Новое уведомление добавлено: прогноз погоды для города {city} каждый день в {notification_time.strftime('%H:%M')} по московскому времени."
+        await sender.send(
+            message.chat.id,
+            f"Новое уведомление добавлено: прогноз погоды для города {city.name} каждый день в {notification_time.strftime('%H:%M')} по московскому времени."
         )
     else:
-        await message.answer(
+        await sender.send(
+            message.chat.id,
             "Некорректный формат. Пожалуйста, используйте команду в формате: `/set HH:MM, Название города` (например, `/set 09:30, Москва`).",
             parse_mode="Markdown"
         )
-        logger.warning(f"Пользователь {message.from_user.id} отправил некорректные данные: {message.text}")
+        logger.warning("Пользователь %s отправил некорректные данные: %s", message.from_user.id, message.text)
 
 # Обработчик команды /edit
 @router.message(Command(commands=['edit']))
-async def initiate_edit_notification(message: Message, db: asyncpg.pool.Pool, state: FSMContext):
+async def initiate_edit_notification(message: Message, repo: Repository, state: FSMContext, sender: MessageSender):
     user_id = message.from_user.id
-    logger.info(f"Получена команда /edit от пользователя {user_id}")
+    logger.info("Получена команда /edit от пользователя %s", user_id)
 
     # Получаем все уведомления пользователя
-    rows = await db.fetch('''
-        SELECT id, city, notification_time FROM users
-        WHERE user_id = $1
-        ORDER BY notification_time
-    ''', user_id)
+    rows = await repo.user_subscriptions(user_id)
 
     if not rows:
-        await message.answer("У вас нет установленных уведомлений. Используйте команду `/set` для их создания.", parse_mode="Markdown")
+        await sender.send(message.chat.id, "У вас нет установленных уведомлений. Используйте команду `/set` для их создания.", parse_mode="Markdown")
         return
 
     # Создаём инлайн-клавиатуру с уведомлениями для выбора
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"ID {row['id']}: {row['notification_time'].strftime('%H:%M')} - {row['city']}",
-                              callback_data=f"edit_{row['id']}")] for row in rows
+        [InlineKeyboardButton(text=f"ID {row.id}: {row.notification_time.strftime('%H:%M')} - {row.city}",
+                              callback_data=f"edit_{row.id}")] for row in rows
     ])
 
-    await message.answer("Выберите уведомление для редактирования:", reply_markup=keyboard)
+    await sender.send(message.chat.id, "Выберите уведомление для редактирования:", reply_markup=keyboard)
 
 # Обработчик выбора уведомления для редактирования
 @router.callback_query(lambda c: c.data and c.data.startswith('edit_'))
-async def edit_selected_notification(callback_query: CallbackQuery, db: asyncpg.pool.Pool, state: FSMContext):
+async def edit_selected_notification(callback_query: CallbackQuery, repo: Repository, state: FSMContext, sender: MessageSender):
     user_id = callback_query.from_user.id
     notification_id = int(callback_query.data.split('_')[1])
 
-    logger.info(f"Пользователь {user_id} выбрал уведомление с ID {notification_id} для редактирования")
+    logger.info("Пользователь %s выбрал уведомление с ID %s для редактирования", user_id, notification_id)
 
     # Проверяем, что уведомление принадлежит пользователю
-    exists = await db.fetchval('''
-        SELECT EXISTS(SELECT 1 FROM users WHERE id = $1 AND user_id = $2)
-    ''', notification_id, user_id)
-
-    if not exists:
-        await callback_query.message.answer("Уведомление не найдено или не принадлежит вам.")
+    if not await repo.owns_subscription(notification_id, user_id):
+        await sender.send(callback_query.message.chat.id, "Уведомление не найдено или не принадлежит вам.")
         await callback_query.answer()
         return
 
-    await callback_query.message.answer(
+    await sender.send(
+        callback_query.message.chat.id,
         "Отправьте новое время и город в формате: `HH:MM, Название города` (например, `10:00, Санкт-Петербург`).",
         parse_mode="Markdown"
     )
@@ -209,7 +230,7 @@ async def edit_selected_notification(callback_query: CallbackQuery, db: asyncpg.
 
 # Обработка нового ввода для редактирования
 @router.message(EditNotificationStates.waiting_for_new_data)
-async def process_new_edit_data(message: Message, db: asyncpg.pool.Pool, state: FSMContext):
+async def process_new_edit_data(message: Message, repo: Repository, state: FSMContext, sender: MessageSender, resolver: CityResolver, index: SubscriptionIndex):
     user_input = message.text.strip()
 
     parsed = parse_time_and_city(user_input)
@@ -217,215 +238,247 @@ async def process_new_edit_data(message: Message, db: asyncpg.pool.Pool, state:
         data = await state.get_data()
         notification_id = data.get('notification_id')
         if not notification_id:
-            await message.answer("Произошла ошибка. Попробуйте снова.")
+            await sender.send(message.chat.id, "Произошла ошибка. Попробуйте снова.")
             await state.clear()
             return
 
         new_time = parsed['time']
-        new_city = parsed['city']
+        new_city = await resolve_city_or_reply(resolver, sender, message.chat.id, parsed['city'])
+        if new_city is None:
+            return
 
-        logger.info(f"Обновление уведомления ID {notification_id} для пользователя {message.from_user.id}: город {new_city}, время {new_time}")
+        logger.info("Обновление уведомления ID %s для пользователя %s: город %s, время %s", notification_id, message.from_user.id, new_city.name, new_time)
 
-        await db.execute('''
-            UPDATE users
-            SET city = $1, notification_time = $2
-            WHERE id = $3
-        ''', new_city, new_time, notification_id)
+        user_id = message.from_user.id
+        if not await repo.update_subscription(notification_id, user_id, new_city, new_time):
+            await sender.send(message.chat.id, "Уведомление не найдено или не принадлежит вам.")
+            await state.clear()
+            return
+        index.add(notification_id, user_id, new_city.id, new_city.name, new_time)
 
-        await message.answer(
-            f"Уведомление обновлено: прогноз погоды для города {new_city} каждый день в {new_time.strftime('%H:%M')} по московскому времени."
+        await sender.send(
+            message.chat.id,
+            f"Уведомление обновлено: прогноз погоды для города {new_city.name} каждый день в {new_time.strftime('%H:%M')} по московскому времени."
         )
         await state.clear()
     else:
-        await message.answer(
+        await sender.send(
+            message.chat.id,
             "Некорректный формат. Пожалуйста, используйте формат: `HH:MM, Название города` (например, `10:00, Санкт-Петербург`).",
             parse_mode="Markdown"
         )
-        logger.warning(f"Пользователь {message.from_user.id} отправил некорректные данные при редактировании: {message.text}")
+        logger.warning("Пользователь %s отправил некорректные данные при редактировании: %s", message.from_user.id, message.text)
 
 # Обработчик команды /clear
 @router.message(Command(commands=['clear']))
-async def clear_notification_settings(message: Message, db: asyncpg.pool.Pool):
+async def clear_notification_settings(message: Message, repo: Repository, sender: MessageSender, index: SubscriptionIndex):
     user_id = message.from_user.id
-    logger.info(f"Получена команда /clear от пользователя {user_id}")
-
-    # Проверяем, существует ли запись для пользователя
-    exists = await db.fetchval('SELECT EXISTS(SELECT 1 FROM users WHERE user_id = $1)', user_id)
-    if exists:
-        await db.execute('DELETE FROM users WHERE user_id = $1', user_id)
-        await message.answer("Ваши настройки уведомлений о погоде были успешно удалены. Вы больше не будете получать прогнозы.")
-        logger.info(f"Настройки пользователя {user_id} были удалены.")
+    logger.info("Получена команда /clear от пользователя %s", user_id)
+
+    if await repo.delete_user_subscriptions(user_id):
+        index.remove_user(user_id)
+        await sender.send(message.chat.id, "Ваши настройки уведомлений о погоде были успешно удалены. Вы больше не будете получать прогнозы.")
+        logger.info("Настройки пользователя %s были удалены.", user_id)
     else:
-        await message.answer("У вас нет установленных уведомлений о погоде.")
-        logger.info(f"Пользователь {user_id} попытался очистить несуществующие настройки.")
+        await sender.send(message.chat.id, "У вас нет установленных уведомлений о погоде.")
+        logger.info("Пользователь %s попытался очистить несуществующие настройки.", user_id)
 
 # Обработчик команды /list
 @router.message(Command(commands=['list']))
-async def list_notifications(message: Message, db: asyncpg.pool.Pool):
+async def list_notifications(message: Message, repo: Repository, sender: MessageSender):
     user_id = message.from_user.id
-    logger.info(f"Получена команда /list от пользователя {user_id}")
+    logger.info("Получена команда /list от пользователя %s", user_id)
 
     # Получаем все уведомления пользователя
-    rows = await db.fetch('''
-        SELECT id, city, notification_time FROM users
-        WHERE user_id = $1
-        ORDER BY notification_time
-    ''', user_id)
+    rows = await repo.user_subscriptions(user_id)
 
     if not rows:
-        await message.answer("У вас нет установленных уведомлений. Используйте команду `/set` для их создания.", parse_mode="Markdown")
+        await sender.send(message.chat.id, "У вас нет установленных уведомлений. Используйте команду `/set` для их создания.", parse_mode="Markdown")
         return
 
     # Форматируем список уведомлений
     notifications = []
     for row in rows:
-        notifications.append(f"**ID {row['id']}**: {row['notification_time'].strftime('%H:%M')} - {row['city']}")
+        notifications.append(f"**ID {row.id}**: {row.notification_time.strftime('%H:%M')} - {row.city}")
 
     notifications_text = "\n".join(notifications)
 
-    await message.answer(
+    await sender.send(
+        message.chat.id,
         f"Ваши текущие уведомления о погоде:\n{notifications_text}",
         parse_mode="Markdown"
     )
 
 # Обработчик команды /delete
 @router.message(Command(commands=['delete']))
-async def initiate_delete_notification(message: Message, db: asyncpg.pool.Pool):
+async def initiate_delete_notification(message: Message, repo: Repository, sender: MessageSender):
     user_id = message.from_user.id
-    logger.info(f"Получена команда /delete от пользователя {user_id}")
+    logger.info("Получена команда /delete от пользователя %s", user_id)
 
     # Получаем все уведомления пользователя
-    rows = await db.fetch('''
-        SELECT id, city, notification_time FROM users
-        WHERE user_id = $1
-        ORDER BY notification_time
-    ''', user_id)
+    rows = await repo.user_subscriptions(user_id)
 
     if not rows:
-        await message.answer("У вас нет установленных уведомлений для удаления.")
+        await sender.send(message.chat.id, "У вас нет установленных уведомлений для удаления.")
         return
 
     # Создаём инлайн-клавиатуру с уведомлениями для выбора
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"ID {row['id']}: {row['notification_time'].strftime('%H:%M')} - {row['city']}",
-                              callback_data=f"delete_{row['id']}")] for row in rows
+        [InlineKeyboardButton(text=f"ID {row.id}: {row.notification_time.strftime('%H:%M')} - {row.city}",
+                              callback_data=f"delete_{row.id}")] for row in rows
     ])
 
-    await message.answer("Выберите уведомление для удаления:", reply_markup=keyboard)
+    await sender.send(message.chat.id, "Выберите уведомление для удаления:", reply_markup=keyboard)
 
 # Обработчик выбора уведомления для удаления
 @router.callback_query(lambda c: c.data and c.data.startswith('delete_'))
-async def delete_selected_notification(callback_query: CallbackQuery, db: asyncpg.pool.Pool):
+async def delete_selected_notification(callback_query: CallbackQuery, repo: Repository, sender: MessageSender, index: SubscriptionIndex):
     user_id = callback_query.from_user.id
     notification_id = int(callback_query.data.split('_')[1])
 
-    logger.info(f"Пользователь {user_id} выбрал уведомление с ID {notification_id} для удаления")
+    logger.info("Пользователь %s выбрал уведомление с ID %s для удаления", user_id, notification_id)
 
-    # Проверяем, что уведомление принадлежит пользователю
-    exists = await db.fetchval('''
-        SELECT EXISTS(SELECT 1 FROM users WHERE id = $1 AND user_id = $2)
-    ''', notification_id, user_id)
-
-    if not exists:
-        await callback_query.message.answer("Уведомление не найдено или не принадлежит вам.")
+    # Удаляем уведомление; чужое или уже удалённое не найдётся
+    if not await repo.delete_subscription(notification_id, user_id):
+        await sender.send(callback_query.message.chat.id, "Уведомление не найдено или не принадлежит вам.")
         await callback_query.answer()
         return
+    index.remove(notification_id)
 
-    # Удаляем уведомление
-    await db.execute('''
-        DELETE FROM users WHERE id = $1
-    ''', notification_id)
-
-    await callback_query.message.answer(f"Уведомление ID {notification_id} было успешно удалено.")
-    logger.info(f"Уведомление ID {notification_id} пользователя {user_id} было удалено.")
+    await sender.send(callback_query.message.chat.id, f"Уведомление ID {notification_id} было успешно удалено.")
+    logger.info("Уведомление ID %s пользователя %s было удалено.", notification_id, user_id)
 
     await callback_query.answer()
 
+async def quick_view(resolver: CityResolver, names: List[str]) -> Optional[str]:
+    """
+    Текущая погода в нескольких городах одной строкой на город: все города
+    загружаются одним вызовом /group. None, если погоды нет ни для одного.
+    """
+    resolved = await asyncio.gather(*(resolver.resolve(name) for name in names), return_exceptions=True)
+    cities = [city for city in resolved if isinstance(city, City)]
+    if not cities:
+        return None
+    conditions = await get_conditions(city.id for city in cities)
+    lines = [render_conditions(city.name, conditions[city.id]) for city in cities if conditions.get(city.id)]
+    if not lines:
+        return None
+    return "Сейчас:\n" + "\n".join(lines)
+
 # Обработчик команды /forecast
 @router.message(Command(commands=['forecast']))
-async def forecast_command(message: Message, db: asyncpg.pool.Pool):
+async def forecast_command(message: Message, bot: Bot, repo: Repository, sender: MessageSender, resolver: CityResolver):
     user_id = message.from_user.id
 
     # Получаем наиболее часто используемые города пользователя
-    rows = await db.fetch('''
-        SELECT city FROM user_cities
-        WHERE user_id = $1
-        ORDER BY frequency DESC
-        LIMIT 5
-    ''', user_id)
-
-    if rows:
-        cities = [row['city'] for row in rows]
-    else:
+    cities = await repo.favorite_cities(user_id)
+    if not cities:
         cities = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань']
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=city, callback_data=CityCallback(city_name=city).pack())] for city in cities
-    ])
-    keyboard.add(InlineKeyboardButton(text="Другой город", switch_inline_query_current_chat=""))
+    rows = [[InlineKeyboardButton(text=city, callback_data=CityCallback(city_name=city).pack())] for city in cities]
+    rows.append([InlineKeyboardButton(text="Другой город", switch_inline_query_current_chat="")])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
 
-    await message.answer("Выберите город из списка или отправьте название города:", reply_markup=keyboard)
+    # Кнопки уходят сразу; текущая погода в этих городах дописывается над ними, если успеет
+    sent = sender.send(message.chat.id, "Выберите город из списка или отправьте название города:", reply_markup=keyboard)
+    try:
+        summary = await asyncio.wait_for(quick_view(resolver, cities), settings.QUICK_VIEW_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Текущая погода для /forecast пользователя %s не получена за %s с.", user_id, settings.QUICK_VIEW_TIMEOUT)
+        return
+    if not summary:
+        return
+    try:
+        prompt = await asyncio.wait_for(asyncio.shield(sent), settings.QUICK_VIEW_TIMEOUT)
+        await bot.edit_message_text(
+            f"{summary}\n\nПрогноз на сутки — выберите город или отправьте его название:",
+            chat_id=message.chat.id,
+            message_id=prompt.message_id,
+            reply_markup=keyboard,
+        )
+    except Exception as e:
+        logger.warning("Не удалось дописать текущую погоду в /forecast пользователя %s: %s", user_id, e)
 
 # Обработчик выбора города
 @router.callback_query(CityCallback.filter())
-async def city_selected(callback_query: CallbackQuery, callback_data: CityCallback, db: asyncpg.pool.Pool):
+async def city_selected(callback_query: CallbackQuery, callback_data: CityCallback, repo: Repository, sender: MessageSender, resolver: CityResolver):
     city_name = callback_data.city_name
     user_id = callback_query.from_user.id
 
-    logger.info(f"Пользователь {user_id} выбрал город {city_name}")
+    logger.info("Пользователь %s выбрал город %s", user_id, city_name)
+
+    city = await resolve_city_or_reply(resolver, sender, callback_query.message.chat.id, city_name)
+    if city is None:
+        await callback_query.answer()
+        return
 
     # Обновляем или добавляем частоту использования города для пользователя
-    await db.execute('''
-        INSERT INTO user_cities (user_id, city, frequency)
-        VALUES ($1, $2, 1)
-        ON CONFLICT (user_id, city) DO UPDATE
-        SET frequency = user_cities.frequency + 1
-    ''', user_id, city_name)
+    repo.record_city_use(user_id, city)
 
     # Получаем прогноз погоды на ближайшие 24 часа
-    weather_data = await get_weather(city_name, hours=24)
+    weather_data = await get_weather(city.id)
     if weather_data:
-        forecast_message = f"Прогноз погоды для {city_name} на ближайшие 24 часа:\n"
-        forecasts = weather_data.get('list', [])[:8]  # 8 прогнозов (3 часа)
-
-        for forecast in forecasts:
-            dt_txt = forecast['dt_txt']
-            temp = forecast['main']['temp']
-            description = forecast['weather'][0]['description']
-            forecast_message += f"{dt_txt}: {temp}°C, {description}\n"
-
-        await callback_query.message.answer(forecast_message)
+        forecast_message = render_forecast(city.id, city.name, weather_data)
+        await sender.send(callback_query.message.chat.id, forecast_message)
     else:
-        await callback_query.message.answer("Не удалось получить данные о погоде.")
-        logger.warning(f"Не удалось получить данные о погоде для города: {city_name}")
+        await sender.send(callback_query.message.chat.id, "Не удалось получить данные о погоде.")
+        logger.warning("Не удалось получить данные о погоде для города: %s", city_name)
 
     await callback_query.answer()
 
 # Обработчик сообщений без команд
 @router.message(lambda message: message.text and not message.text.startswith('/'))
-async def send_forecast_on_city_name(message: Message, db: asyncpg.pool.Pool):
+async def send_forecast_on_city_name(message: Message, repo: Repository, sender: MessageSender, resolver: CityResolver):
     city_name = message.text.strip()
     user_id = message.from_user.id
 
-    logger.info(f"Получено сообщение с названием города от пользователя {user_id}: {city_name}")
+    logger.info("Получено сообщение с названием города от пользователя %s: %s", user_id, city_name)
 
     if not city_name:
-        await message.answer("Пожалуйста, отправьте корректное название города.")
-        logger.warning(f"Пользователь {user_id} отправил пустое название города.")
+        await sender.send(message.chat.id, "Пожалуйста, отправьте корректное название города.")
+        logger.warning("Пользователь %s отправил пустое название города.", user_id)
         return
 
-    weather_data = await get_weather(city_name, hours=24)
-    if weather_data:
-        forecast_message = f"Прогноз погоды для {city_name} на ближайшие 24 часа:\n"
-        forecasts = weather_data.get('list', [])[:8]  # 8 прогнозов (3 часа)
-
-        for forecast in forecasts:
-            dt_txt = forecast['dt_txt']
-            temp = forecast['main']['temp']
-            description = forecast['weather'][0]['description']
-            forecast_message += f"{dt_txt}: {temp}°C, {description}\n"
+    city = await resolve_city_or_reply(resolver, sender, message.chat.id, city_name)
+    if city is None:
+        return
 
-        await message.answer(forecast_message)
+    weather_data = await get_weather(city.id)
+    if weather_data:
+        forecast_message = render_forecast(city.id, city.name, weather_data)
+        await sender.send(message.chat.id, forecast_message)
     else:
-        await message.answer("Не удалось получить данные о погоде.")
-        logger.warning(f"Не удалось получить данные о погоде для города: {city_name}")
+        await sender.send(message.chat.id, "Не удалось получить данные о погоде.")
+        logger.warning("Не удалось получить данные о погоде для города: %s", city_name)
+
+def _city_article(entry: CityEntry, description: str) -> InlineQueryResultArticle:
+    # Выбранная подсказка отправляется в чат как «Название, RU» и разбирается обработчиком названий
+    return InlineQueryResultArticle(
+        id=str(entry.id),
+        title=entry.name,
+        description=description,
+        input_message_content=InputTextMessageContent(message_text=entry.label()),
+    )
+
+# Подсказки городов в инлайн-режиме: «@бот Мос» или кнопка «Другой город»
+@router.inline_query()
+async def inline_city_search(inline_query: InlineQuery, repo: Repository, city_index: CityIndex):
+    query = inline_query.query.strip()
+    limit = settings.INLINE_RESULTS
+
+    # Сначала частые города пользователя, подходящие к запросу, затем список городов
+    prefix = fold_name(query)
+    favorites = [
+        (city, frequency) for city, frequency in await repo.frequent_cities(inline_query.from_user.id, limit)
+        if fold_name(city.name).startswith(prefix)
+    ]
+    results = [
+        _city_article(CityEntry(city.id, city.name, ''), f"Выбран раз: {frequency}")
+        for city, frequency in favorites
+    ]
+    if query and len(results) < limit:
+        exclude = [city.id for city, _ in favorites]
+        for entry in city_index.search(query, limit - len(results), exclude=exclude):
+            results.append(_city_article(entry, entry.country))
+
+    await inline_query.answer(results, cache_time=settings.INLINE_CACHE_TIME, is_personal=True)
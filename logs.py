@@ -0,0 +1,123 @@
+# logs.py
+
+import copy
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+FORMAT = '[%(asctime)s] %(levelname)s:%(name)s:%(message)s'
+
+# Сколько разных шаблонов сообщений отслеживает SampleFilter, прежде чем забыть все окна
+MAX_TEMPLATES = 1000
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Передаёт записи в очередь, не форматируя их в потоке цикла событий.
+
+    Подставляются только аргументы сообщения, потому что объекты могут измениться
+    до записи. Дата, формат и трассировка исключения собираются в потоке записи.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class SampleFilter(logging.Filter):
+    """
+    Пропускает не больше burst записей с одним шаблоном сообщения за interval секунд.
+
+    Сообщения пишутся с ленивым %-форматированием, поэтому строки вида «ошибка
+    отправки в чат %s» от разных пользователей имеют общий шаблон. Первая запись
+    следующего окна сообщает, сколько похожих было пропущено. Записи уровня выше
+    max_level проходят всегда.
+    """
+    def __init__(self, burst: int, interval: float, max_level: int = logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_level = max_level
+        self._windows: Dict[Tuple[str, str], List] = {}  # (логгер, шаблон) -> [начало окна, пропущено, отброшено]
+        self._last: Optional[Tuple[logging.LogRecord, bool]] = None
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Один фильтр может стоять на нескольких обработчиках: запись считается один раз
+        if self._last is not None and self._last[0] is record:
+            return self._last[1]
+        passed = self._check(record)
+        self._last = (record, passed)
+        return passed
+
+    def _check(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.levelno > self.max_level:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is None and len(self._windows) >= MAX_TEMPLATES:
+                self._windows.clear()
+            dropped = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if dropped:
+                record.msg = f"{record.msg} [пропущено похожих записей: {dropped}]"
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        self.suppressed += 1
+        return False
+
+def setup_logging(
+    level: str = 'INFO',
+    path: Optional[str] = 'bot.log',
+    max_bytes: int = 1_000_000,
+    backup_count: int = 5,
+    queued: bool = True,
+    console: bool = True,
+    sample_burst: int = 0,
+    sample_interval: float = 60.0,
+) -> Optional[logging.handlers.QueueListener]:
+    """
+    Настраивает вывод логов в stdout (console) и файл с ротацией (path).
+
+    С queued запись в поток вывода, в файл и ротация выполняются в отдельном
+    потоке QueueListener, а цикл событий только кладёт запись в очередь.
+    Возвращает запущенный QueueListener, который нужно остановить при выходе,
+    чтобы дописать очередь.
+    """
+    formatter = logging.Formatter(FORMAT)
+    handlers: List[logging.Handler] = []
+    if console:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    if path:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8',
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+    listener = None
+    if queued:
+        front = _QueueHandler(queue.SimpleQueue())
+        listener = logging.handlers.QueueListener(front.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        handlers = [front]
+    # С очередью фильтр стоит перед ней: отброшенная запись в очередь не попадает
+    sampler = SampleFilter(sample_burst, sample_interval) if sample_burst > 0 else None
+    for handler in handlers:
+        if sampler is not None:
+            handler.addFilter(sampler)
+        root.addHandler(handler)
+    return listener
@@ -0,0 +1,139 @@
+# metrics.py
+
+import logging
+from typing import Optional
+
+import asyncpg
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм задержек: от быстрых попаданий в кэш до медленных ответов внешних API
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Тик рассылки длится от секунд до минут
+TICK_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# Фазы пачки: подготовка занимает миллисекунды, отправка через очередь — до минут
+PHASE_BUCKETS = LATENCY_BUCKETS + (60.0, 120.0, 300.0, 600.0)
+
+WEATHER_SECONDS = Histogram(
+    'weather_get_seconds', 'Время get_weather, включая кэш и ожидание квоты',
+    ['priority'], buckets=LATENCY_BUCKETS,
+)
+WEATHER_RESULTS = Counter(
+    'weather_results_total', 'Итоги get_weather: ok, stale, not_found, error',
+    ['priority', 'result'],
+)
+UPSTREAM_SECONDS = Histogram(
+    'openweather_request_seconds', 'Время HTTP-запроса к OpenWeather',
+    ['endpoint'], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_RESPONSES = Counter(
+    'openweather_responses_total', 'Ответы OpenWeather по коду; network, circuit_open и budget — запрос не выполнен',
+    ['endpoint', 'status'],
+)
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Обращения к двухуровневому кэшу: local_hit, shared_hit, miss',
+    ['namespace', 'result'],
+)
+CACHE_ERRORS = Counter('cache_errors_total', 'Ошибки общего уровня кэша', ['namespace'])
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds', 'Время запроса к Postgres, включая ожидание соединения из пула',
+    ['query'], buckets=LATENCY_BUCKETS,
+)
+TICK_SECONDS = Histogram(
+    'delivery_tick_seconds', 'Длительность тика рассылки: постановка в очередь и доставка',
+    ['kind'], buckets=TICK_BUCKETS,
+)
+DELIVERY_PHASE_SECONDS = Histogram(
+    'delivery_phase_seconds',
+    'Фазы рассылки пачки: prepare, fetch, render, enqueue и send — до отправки всех её сообщений',
+    ['phase'], buckets=PHASE_BUCKETS,
+)
+TICK_LAG_SECONDS = Histogram(
+    'delivery_tick_lag_seconds', 'Опоздание начала рассылки слота относительно его минуты',
+    buckets=TICK_BUCKETS,
+)
+SEND_SECONDS = Histogram(
+    'telegram_send_seconds', 'Время вызова sendMessage',
+    ['priority'], buckets=LATENCY_BUCKETS,
+)
+SEND_QUEUE_SECONDS = Histogram(
+    'telegram_send_queue_seconds', 'Время от постановки сообщения в очередь до успешной отправки',
+    ['priority'], buckets=TICK_BUCKETS,
+)
+SEND_RESULTS = Counter(
+    'telegram_send_total', 'Итоги отправки: sent, retried, failed',
+    ['priority', 'result'],
+)
+UPDATE_SECONDS = Histogram(
+    'update_handling_seconds', 'Время обработки апдейта хендлерами',
+    ['event'], buckets=LATENCY_BUCKETS,
+)
+UPDATE_REJECTIONS = Counter(
+    'update_rejections_total', 'Отклонённые апдейты: user и global — лимит частоты, backlog — очередь вебхука',
+    ['reason'],
+)
+
+class RuntimeCollector:
+    """
+    Текущее состояние сервисов, которое снимается в момент опроса /metrics:
+    заполненность пула соединений, глубина очереди отправки, несброшенные статусы рассылки.
+    """
+    def __init__(self, pool: asyncpg.pool.Pool, sender=None, coordinator=None, breaker=None):
+        self.pool = pool
+        self.sender = sender
+        self.coordinator = coordinator
+        self.breaker = breaker
+
+    def collect(self):
+        size, idle = self.pool.get_size(), self.pool.get_idle_size()
+        connections = GaugeMetricFamily('db_pool_connections', 'Соединения пула Postgres', labels=['state'])
+        connections.add_metric(['busy'], size - idle)
+        connections.add_metric(['idle'], idle)
+        yield connections
+        yield GaugeMetricFamily('db_pool_max_connections', 'Размер пула Postgres', value=self.pool.get_max_size())
+
+        if self.sender is not None:
+            stats = self.sender.stats()
+            depth = GaugeMetricFamily('telegram_send_queue_depth', 'Сообщений в очереди отправки', labels=['priority'])
+            for priority, value in stats['queue_depth'].items():
+                depth.add_metric([priority], value)
+            yield depth
+            yield GaugeMetricFamily('telegram_send_delayed', 'Сообщений, отложенных до повтора', value=stats['delayed'])
+
+        if self.coordinator is not None:
+            yield GaugeMetricFamily(
+                'delivery_unflushed_statuses', 'Статусы рассылки, ещё не записанные в базу',
+                value=self.coordinator.pending_statuses(),
+            )
+
+        if self.breaker is not None:
+            yield GaugeMetricFamily(
+                'openweather_breaker_open', '1, пока предохранитель OpenWeather не закрыт',
+                value=int(self.breaker.state != self.breaker.CLOSED),
+            )
+
+def register_runtime(collector: RuntimeCollector):
+    REGISTRY.register(collector)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """
+    Отдельный сервер /metrics. Метрики не отдаются на публичном сервере вебхука: в них
+    внутренние счётчики, поэтому порт открывается только для сборщика метрик.
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
+
+async def stop_server(runner: Optional[web.AppRunner]):
+    if runner is not None:
+        await runner.cleanup()
@@ -1,11 +1,13 @@
 # middlewares.py
 
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
-from aiogram.types import TelegramObject
+from aiogram.types import CallbackQuery, TelegramObject
 from typing import Callable, Awaitable, Any, Dict
 import asyncpg
 import logging
-from aiolimiter import AsyncLimiter
+import time
+from metrics import UPDATE_REJECTIONS, UPDATE_SECONDS
+from ratelimit import KeyedTokenBuckets, TokenBucket
 
 logger = logging.getLogger(__name__)
 
@@ -20,13 +22,16 @@ class DatabaseMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        data['db'] = self.db.pool
+        data['repo'] = self.db.repo
         return await handler(event, data)
 
-class RateLimitMiddleware(BaseMiddleware):
-    def __init__(self, limiter: AsyncLimiter):
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Замеряет время обработки апдейта хендлерами (гистограмма update_handling_seconds).
+    """
+    def __init__(self, event: str):
         super().__init__()
-        self.limiter = limiter
+        self.histogram = UPDATE_SECONDS.labels(event)
 
     async def __call__(
         self,
@@ -34,6 +39,77 @@ class RateLimitMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        user_id = event.from_user.id
-        async with self.limiter:
+        started = time.perf_counter()
+        try:
             return await handler(event, data)
+        finally:
+            self.histogram.observe(time.perf_counter() - started)
+
+class ServicesMiddleware(BaseMiddleware):
+    """
+    Передаёт в хендлеры общие сервисы приложения (очередь отправки и т.п.) по имени.
+    """
+    def __init__(self, **services: Any):
+        super().__init__()
+        self.services = services
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        data.update(self.services)
+        return await handler(event, data)
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту апдейтов от каждого пользователя и общий поток апдейтов.
+
+    Корзины пользователей хранятся в ограниченном LRU, поэтому память не растёт
+    с числом пользователей. Апдейты сверх лимита отбрасываются сразу, не ожидая очереди.
+    """
+    def __init__(self, user_rate: float, user_burst: float, global_rate: float, max_users: int):
+        super().__init__()
+        self.users = KeyedTokenBuckets(user_rate, user_burst, max_users)
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.rejected_user = 0
+        self.rejected_global = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = getattr(event, 'from_user', None)
+        if user is not None and not self.users.get(user.id).try_acquire():
+            self.rejected_user += 1
+            UPDATE_REJECTIONS.labels('user').inc()
+            logger.debug("Апдейт пользователя %s отклонён: превышен лимит запросов", user.id)
+            await self._reject(event)
+            return None
+        if not self.global_bucket.try_acquire():
+            self.rejected_global += 1
+            UPDATE_REJECTIONS.labels('global').inc()
+            logger.debug("Апдейт отклонён: превышен общий лимит запросов")
+            await self._reject(event)
+            return None
+        return await handler(event, data)
+
+    @staticmethod
+    async def _reject(event: TelegramObject):
+        # Нажатие кнопки без ответа оставляет «часики» в клиенте, поэтому отвечаем на него
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer("Слишком много запросов, попробуйте чуть позже.")
+            except Exception as e:
+                logger.debug("Не удалось ответить на отклонённый callback: %s", e)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'tracked_users': len(self.users),
+            'evicted_users': self.users.evictions,
+            'rejected_user': self.rejected_user,
+            'rejected_global': self.rejected_global,
+        }
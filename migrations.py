@@ -0,0 +1,206 @@
+# migrations.py
+
+import logging
+from typing import List, NamedTuple, Optional, Set, Tuple
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Ключи advisory-блокировок: реплики не применяют миграции одновременно
+MIGRATION_LOCK = 7_240_001
+INDEX_LOCK = 7_240_002
+
+# Миграции не ограничены DB_COMMAND_TIMEOUT: сборка индекса на большой таблице идёт долго
+MIGRATION_TIMEOUT = 3600.0
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: Tuple[str, ...]
+    # Имя индекса, если миграция строит его через CREATE INDEX CONCURRENTLY:
+    # такая миграция выполняется вне транзакции и в фоне, не задерживая старт
+    index: Optional[str] = None
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'users и user_cities', (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            city TEXT NOT NULL,
+            notification_time TIME NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_cities (
+            user_id BIGINT,
+            city TEXT,
+            frequency INT DEFAULT 1,
+            PRIMARY KEY (user_id, city)
+        )
+        ''',
+        # Старые базы с первичным ключом на user_id переводятся на id один раз
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS id SERIAL',
+        '''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1
+                FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY (i.indkey)
+                WHERE i.indrelid = 'users'::regclass AND i.indisprimary AND a.attname = 'id'
+            ) THEN
+                ALTER TABLE users DROP CONSTRAINT IF EXISTS users_pkey;
+                ALTER TABLE users ADD PRIMARY KEY (id);
+            END IF;
+        END
+        $$
+        ''',
+    )),
+    Migration(2, 'справочник городов', (
+        '''
+        CREATE TABLE IF NOT EXISTS cities (
+            id BIGINT PRIMARY KEY,
+            name TEXT NOT NULL,
+            country TEXT,
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS city_aliases (
+            alias TEXT PRIMARY KEY,
+            city_id BIGINT NOT NULL REFERENCES cities (id)
+        )
+        ''',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS city_id BIGINT REFERENCES cities (id)',
+        'ALTER TABLE user_cities ADD COLUMN IF NOT EXISTS city_id BIGINT REFERENCES cities (id)',
+    )),
+    Migration(3, 'общий кэш', (
+        '''
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+        ''',
+    )),
+    Migration(4, 'очередь плановой рассылки', (
+        '''
+        CREATE TABLE IF NOT EXISTS deliveries (
+            subscription_id INT NOT NULL,
+            slot_date DATE NOT NULL,
+            slot_at TIMESTAMPTZ NOT NULL,
+            user_id BIGINT NOT NULL,
+            city_id BIGINT,
+            city TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            claimed_by TEXT,
+            claimed_at TIMESTAMPTZ,
+            sent_at TIMESTAMPTZ,
+            PRIMARY KEY (subscription_id, slot_date)
+        )
+        ''',
+        'ALTER TABLE deliveries ADD COLUMN IF NOT EXISTS sent_at TIMESTAMPTZ',
+        'CREATE INDEX IF NOT EXISTS deliveries_slot_date_idx ON deliveries (slot_date)',
+        '''
+        CREATE INDEX IF NOT EXISTS deliveries_open_idx
+        ON deliveries (slot_at)
+        WHERE status IN ('pending', 'claimed')
+        ''',
+    )),
+    Migration(5, 'индекс подписок по пользователю', (
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_user_id_idx ON users (user_id)',
+    ), index='users_user_id_idx'),
+    Migration(6, 'индекс подписок по времени', (
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_notification_time_idx ON users (notification_time)',
+    ), index='users_notification_time_idx'),
+    Migration(7, 'состояния диалогов FSM', (
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS fsm_states_expires_at_idx ON fsm_states (expires_at)',
+    )),
+    # Ключ по слоту, а не по дню: подписка, перенесённая на более позднее время, приходит и в новый слот
+    Migration(8, 'ключ рассылки по слоту', (
+        'ALTER TABLE deliveries DROP CONSTRAINT IF EXISTS deliveries_pkey',
+        'ALTER TABLE deliveries ADD PRIMARY KEY (subscription_id, slot_at)',
+    )),
+    Migration(9, 'индекс общего кэша по сроку', (
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS cache_entries_expires_at_idx ON cache_entries (expires_at)',
+    ), index='cache_entries_expires_at_idx'),
+]
+
+async def _applied_versions(conn: asyncpg.Connection) -> Set[int]:
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    rows = await conn.fetch('SELECT version FROM schema_migrations')
+    return {row['version'] for row in rows}
+
+async def _drop_invalid_index(conn: asyncpg.Connection, name: str):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, который
+    # IF NOT EXISTS молча пропустил бы
+    invalid = await conn.fetchval(
+        'SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)', name
+    )
+    if invalid:
+        logger.warning("Индекс %s остался невалидным после прерванной сборки, пересоздаём.", name)
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}', timeout=MIGRATION_TIMEOUT)
+
+async def _apply(conn: asyncpg.Connection, migration: Migration):
+    if migration.index is None:
+        async with conn.transaction():
+            for statement in migration.statements:
+                await conn.execute(statement, timeout=MIGRATION_TIMEOUT)
+            await conn.execute(
+                'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)',
+                migration.version, migration.name,
+            )
+    else:
+        await _drop_invalid_index(conn, migration.index)
+        for statement in migration.statements:
+            await conn.execute(statement, timeout=MIGRATION_TIMEOUT)
+        await conn.execute(
+            'INSERT INTO schema_migrations (version, name) VALUES ($1, $2) ON CONFLICT DO NOTHING',
+            migration.version, migration.name,
+        )
+
+async def migrate(pool: asyncpg.pool.Pool, concurrent: bool = False) -> int:
+    """
+    Применяет ещё не применённые миграции одного вида и возвращает их число.
+
+    Без concurrent применяются изменения схемы, нужные до начала работы: каждая в
+    своей транзакции, пока реплика держит advisory-блокировку. С concurrent строятся
+    индексы через CREATE INDEX CONCURRENTLY; это можно делать в фоне, и если индексы
+    уже строит другая реплика, вызов сразу завершается.
+    """
+    lock = INDEX_LOCK if concurrent else MIGRATION_LOCK
+    applied_count = 0
+    async with pool.acquire() as conn:
+        if concurrent:
+            if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', lock):
+                return 0
+        else:
+            await conn.execute('SELECT pg_advisory_lock($1)', lock, timeout=MIGRATION_TIMEOUT)
+        try:
+            applied = await _applied_versions(conn)
+            for migration in MIGRATIONS:
+                if migration.version in applied or (migration.index is not None) != concurrent:
+                    continue
+                logger.info("Применение миграции %s: %s", migration.version, migration.name)
+                await _apply(conn, migration)
+                applied_count += 1
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', lock)
+    return applied_count
@@ -0,0 +1,135 @@
+# prefetch.py
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from cache import TwoTierCache
+from ratelimit import Priority
+from subscriptions import SubscriptionIndex, MINUTES_PER_DAY, MOSCOW_TZ, minute_of_day
+from weather import get_conditions, get_weather
+
+logger = logging.getLogger(__name__)
+
+# Запас до конца минуты, в который упреждающие запросы уже не планируются
+SPREAD_MARGIN = 5.0
+
+class Prefetcher:
+    """
+    Заранее прогревает кэш прогнозов для городов, рассылка по которым начнётся
+    в ближайшие window минут.
+
+    Каждую минуту в окно попадает очередной слот; его города загружаются
+    равномерно в течение этой минуты, чтобы популярный слот не создавал всплеск
+    запросов к OpenWeather. Тик рассылки затем читает прогнозы из кэша.
+
+    С conditions прогревается текущая погода для краткой сводки: города идут
+    пачками по group_size, по одному вызову /group на пачку.
+
+    Прогретым город считается по сроку записи в локальном уровне cache: запись,
+    которая истечёт раньше конца самого дальнего слота окна, загружается заново.
+    Попадания в record() — это записи, реально лежащие в кэше в момент рассылки.
+    """
+    def __init__(
+        self,
+        index: SubscriptionIndex,
+        window: int,
+        cache: TwoTierCache,
+        conditions: bool = False,
+        group_size: int = 20,
+    ):
+        self.index = index
+        self.window = window
+        self.cache = cache
+        # Запись должна дожить до конца минуты самого дальнего слота окна
+        self.min_ttl = min((window + 1) * 60.0, cache.ttl)
+        self.conditions = conditions
+        self.group_size = group_size
+
+        self.fetched = 0
+        self.failed = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _is_warm(self, city_id: int) -> bool:
+        return self.cache.local.remaining(str(city_id)) >= self.min_ttl
+
+    def _cities_for(self, minutes: Iterable[int]) -> List[int]:
+        city_ids = {}
+        for minute in minutes:
+            for subscription in self.index.due(minute):
+                city_id = subscription.city_id
+                if city_id is not None and not self._is_warm(city_id):
+                    city_ids[city_id] = None
+        return list(city_ids)
+
+    def record(self, city_ids: Iterable[int]):
+        """
+        Учитывает, лежат ли города рассылки в локальном уровне кэша перед её загрузкой.
+        """
+        for city_id in city_ids:
+            if self.cache.local.remaining(str(city_id)) > 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    async def _prefetch(self, city_ids: List[int], deadline: float):
+        """
+        Загружает города, равномерно распределяя запросы до deadline (time.monotonic()).
+        """
+        if not city_ids:
+            return
+        step = self.group_size if self.conditions else 1
+        chunks = [city_ids[i:i + step] for i in range(0, len(city_ids), step)]
+        interval = max(deadline - time.monotonic(), 0.0) / len(chunks)
+        for chunk in chunks:
+            started = time.monotonic()
+            loaded = await self._load(chunk)
+            for city_id in chunk:
+                if loaded.get(city_id):
+                    self.fetched += 1
+                else:
+                    self.failed += 1
+            await asyncio.sleep(max(interval - (time.monotonic() - started), 0.0))
+
+    async def _load(self, city_ids: List[int]) -> Dict[int, object]:
+        if self.conditions:
+            return await get_conditions(city_ids, Priority.PREFETCH, self.min_ttl)
+        city_id = city_ids[0]
+        try:
+            return {city_id: await get_weather(city_id, Priority.PREFETCH, self.min_ttl)}
+        except Exception as e:
+            logger.error("Ошибка упреждающей загрузки прогноза для города %s: %s", city_id, e)
+            return {}
+
+    async def run(self):
+        last_minute: Optional[int] = None
+        while True:
+            now = datetime.now(MOSCOW_TZ)
+            current = minute_of_day(now.time())
+            if last_minute is None:
+                # При старте прогреваем всё окно целиком
+                offsets = range(1, self.window + 1)
+            else:
+                missed = min((current - last_minute) % MINUTES_PER_DAY, self.window)
+                offsets = range(self.window - missed + 1, self.window + 1)
+            last_minute = current
+
+            next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+            remaining = (next_minute - now).total_seconds()
+            cities = self._cities_for((current + offset) % MINUTES_PER_DAY for offset in offsets)
+            if cities:
+                logger.info("Упреждающая загрузка %s городов для слотов через %s-%s мин.", len(cities), offsets.start, offsets.stop - 1)
+            await self._prefetch(cities, time.monotonic() + max(remaining - SPREAD_MARGIN, 0.0))
+
+            await asyncio.sleep(max((next_minute - datetime.now(MOSCOW_TZ)).total_seconds(), 0.0))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'fetched': self.fetched,
+            'failed': self.failed,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,97 @@
+# ratelimit.py
+
+import asyncio
+import time
+from collections import OrderedDict
+from enum import IntEnum
+from typing import Hashable
+
+class Priority(IntEnum):
+    """
+    Приоритет исходящей работы: чем меньше значение, тем раньше выполняется.
+    """
+    INTERACTIVE = 0
+    SCHEDULED = 1
+    PREFETCH = 2
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не более capacity в запасе.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """
+        Сколько секунд ждать, пока в корзине появится tokens токенов.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.updated - now)  # корзина может быть «заморожена» через penalize
+        if self.tokens >= tokens:
+            return wait
+        return wait + (tokens - self.tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        if self.delay(tokens) > 0:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1.0):
+        while True:
+            wait = self.delay(tokens)
+            if wait <= 0:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep(wait)
+
+    def refund(self, tokens: float = 1.0):
+        """
+        Возвращает взятые, но не использованные токены.
+        """
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def penalize(self, seconds: float):
+        """
+        Опустошает корзину и запрещает выдачу токенов на seconds секунд (например, по retry_after).
+        """
+        self.tokens = 0.0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+class KeyedTokenBuckets:
+    """
+    Набор корзин по ключу (чат, пользователь) с ограничением размера: при переполнении
+    вытесняется корзина, к которой дольше всего не обращались.
+    """
+    def __init__(self, rate: float, capacity: float, max_size: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets: 'OrderedDict[Hashable, TokenBucket]' = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,45 @@
+# render.py
+
+from itertools import islice
+
+from cache import LRUCache
+from config import settings
+from forecast import FORECAST_SLOTS, Conditions, Forecast
+
+# Готовые тексты по (город, название в тексте, версия прогноза, число интервалов)
+_rendered = LRUCache(settings.RENDER_CACHE_SIZE)
+
+def render_forecast(city_id: int, city_name: str, forecast: Forecast, slots: int = FORECAST_SLOTS) -> str:
+    """
+    Формирует текст прогноза погоды. Для одной версии прогноза текст строится
+    один раз и переиспользуется всеми получателями; обновлённый прогноз получает
+    новую версию, и старый текст вытесняется из кэша.
+    """
+    # Название входит в ключ: один город может прийти под разными написаниями («Moscow» и «Москва»)
+    key = f"{city_id}:{city_name}:{forecast.fetched_at}:{slots}"
+    text = _rendered.get(key)
+    if text is not None:
+        return text
+
+    lines = [f"Прогноз погоды для {city_name} на ближайшие {slots * 3} часа:"]
+    for dt_txt, temp, description in islice(forecast.entries(), slots):
+        lines.append(f"{dt_txt}: {temp:g}°C, {description}")
+    text = '\n'.join(lines) + '\n'
+
+    _rendered.set(key, text, settings.WEATHER_STALE_TTL)
+    return text
+
+def render_conditions(city_name: str, conditions: Conditions) -> str:
+    """
+    Одна строка с текущей погодой: для быстрого просмотра нескольких городов.
+    """
+    return f"{city_name}: {round(conditions.temp)}°C (ощущается как {round(conditions.feels_like)}°C), {conditions.description}"
+
+def render_summary(city_name: str, conditions: Conditions) -> str:
+    """
+    Краткая плановая сводка: текущая погода вместо прогноза на сутки.
+    """
+    return (
+        f"Погода в {city_name} сейчас: {round(conditions.temp)}°C, {conditions.description}.\n"
+        f"Ощущается как {round(conditions.feels_like)}°C. Прогноз на сутки: /forecast"
+    )
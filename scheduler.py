@@ -0,0 +1,353 @@
+# scheduler.py
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from functools import partial
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from cities import City, CityResolver
+from config import settings
+from deliveries import Claim, DeliveryCoordinator
+from forecast import Forecast
+from metrics import DELIVERY_PHASE_SECONDS, TICK_LAG_SECONDS, TICK_SECONDS
+from ratelimit import Priority
+from sender import MessageSender
+from prefetch import Prefetcher
+from render import render_forecast, render_summary
+from subscriptions import Subscription, SubscriptionIndex, MINUTES_PER_DAY, MOSCOW_TZ, current_minute, minute_of_day
+from weather import get_conditions, get_weather
+
+logger = logging.getLogger(__name__)
+
+# Сколько названий городов без прогноза перечисляется в строке лога пачки
+MAX_LOGGED_CITIES = 10
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks: Set[asyncio.Task] = set()
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _fetch_forecasts(city_ids, concurrency: int) -> Dict[int, Optional[Forecast]]:
+    """
+    Загружает прогнозы для набора городов, не более concurrency запросов одновременно.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(city_id: int) -> Optional[Forecast]:
+        async with semaphore:
+            try:
+                return await get_weather(city_id, Priority.SCHEDULED)
+            except Exception as e:
+                logger.error("Ошибка при получении прогноза погоды для города %s: %s", city_id, e)
+                return None
+
+    city_ids = list(city_ids)
+    results = await asyncio.gather(*(fetch(city_id) for city_id in city_ids))
+    return dict(zip(city_ids, results))
+
+async def _resolve_city_ids(subscriptions: List[Subscription], resolver: CityResolver) -> Dict[str, City]:
+    """
+    Сопоставляет со справочником города подписок, у которых ещё нет city_id.
+    """
+    names = {subscription.city for subscription in subscriptions if subscription.city_id is None}
+    resolved: Dict[str, City] = {}
+    for name in names:
+        try:
+            city = await resolver.resolve(name, Priority.SCHEDULED)
+        except Exception as e:
+            logger.error("Ошибка при сопоставлении города %s: %s", name, e)
+            city = None
+        if city is not None:
+            resolved[name] = city
+    return resolved
+
+async def _deliver(
+    subscriptions: List[Subscription],
+    slot: str,
+    sender: MessageSender,
+    resolver: CityResolver,
+    prefetcher: Optional[Prefetcher] = None,
+) -> List[Tuple[Subscription, asyncio.Future]]:
+    """
+    Загружает и форматирует прогнозы для подписок и ставит сообщения в очередь отправки.
+
+    Возвращает пары (подписка, future отправки).
+    """
+    started = time.perf_counter()
+
+    # Группируем подписки по id города: каждый город загружается и форматируется один раз
+    legacy = await _resolve_city_ids(subscriptions, resolver)
+    recipients: Dict[int, List[Subscription]] = defaultdict(list)
+    names: Dict[int, str] = {}
+    failed: List[Subscription] = []
+    for subscription in subscriptions:
+        city_id, name = subscription.city_id, subscription.city
+        if city_id is None:
+            if subscription.city not in legacy:
+                failed.append(subscription)
+                continue
+            city_id, name = legacy[subscription.city]
+        recipients[city_id].append(subscription)
+        names.setdefault(city_id, name)
+    queried = time.perf_counter()
+
+    if prefetcher is not None:
+        prefetcher.record(recipients)
+
+    summary = settings.SCHEDULED_FORMAT == 'summary'
+    if summary:
+        # Текущая погода всех городов пачки: один вызов /group на GROUP_BATCH_SIZE городов
+        weather = await get_conditions(recipients, Priority.SCHEDULED)
+    else:
+        weather = await _fetch_forecasts(recipients, settings.WEATHER_FETCH_CONCURRENCY)
+    fetched = time.perf_counter()
+
+    messages: List[Tuple[Subscription, str]] = [
+        (subscription, "Не удалось получить данные о погоде.") for subscription in failed
+    ]
+    unavailable: List[str] = []
+    for city_id, city_subscriptions in recipients.items():
+        weather_data = weather.get(city_id)
+        if weather_data and summary:
+            text = render_summary(names[city_id], weather_data)
+        elif weather_data:
+            text = render_forecast(city_id, names[city_id], weather_data)
+        else:
+            text = "Не удалось получить данные о погоде."
+            unavailable.append(names[city_id])
+        messages.extend((subscription, text) for subscription in city_subscriptions)
+    rendered = time.perf_counter()
+
+    deliveries = [
+        (subscription, sender.send(subscription.user_id, text, priority=Priority.SCHEDULED))
+        for subscription, text in messages
+    ]
+    sent = time.perf_counter()
+    DELIVERY_PHASE_SECONDS.labels('prepare').observe(queried - started)
+    DELIVERY_PHASE_SECONDS.labels('fetch').observe(fetched - queried)
+    DELIVERY_PHASE_SECONDS.labels('render').observe(rendered - fetched)
+    DELIVERY_PHASE_SECONDS.labels('enqueue').observe(sent - rendered)
+
+    # Одна строка на пачку вместо строки на каждый город или подписку
+    if unavailable:
+        logger.warning(
+            "Рассылка %s: нет прогноза для %d городов (%s)",
+            slot, len(unavailable), ', '.join(unavailable[:MAX_LOGGED_CITIES]),
+        )
+    logger.debug(
+        "Рассылка %s: в очереди %d сообщений, городов %d; подготовка %.3fс, загрузка %.3fс, "
+        "рендер %.3fс, постановка в очередь %.3fс",
+        slot, len(messages), len(recipients),
+        queried - started, fetched - queried, rendered - fetched, sent - rendered,
+    )
+    return deliveries
+
+async def _hold_claims(coordinator: DeliveryCoordinator, pending: List[Tuple[Claim, asyncio.Future]]):
+    """
+    Продлевает аренду записей, сообщения которых ещё не отправлены: очередь отправки
+    после простоя может разбираться дольше аренды, и другая реплика отправила бы их повторно.
+    """
+    while True:
+        await asyncio.sleep(coordinator.lease / 3)
+        held = [claim for claim, future in pending if not future.done()]
+        if not held:
+            return
+        try:
+            await coordinator.extend(held)
+        except Exception as e:
+            logger.error("Ошибка продления аренды %d записей рассылки: %s", len(held), e)
+
+async def _deliver_claims(
+    coordinator: DeliveryCoordinator,
+    claims: List[Claim],
+    slot: str,
+    sender: MessageSender,
+    resolver: CityResolver,
+    prefetcher: Optional[Prefetcher],
+) -> int:
+    # Дорассылка за несколько минут может захватить одну подписку дважды, если её время перенесли
+    by_id: Dict[int, List[Claim]] = defaultdict(list)
+    for claim in claims:
+        by_id[claim.subscription.id].append(claim)
+    deliveries = await _deliver([claim.subscription for claim in claims], slot, sender, resolver, prefetcher)
+
+    def on_done(future: asyncio.Future, claim: Claim):
+        # Неотправленные при остановке сообщения остаются захваченными: после
+        # истечения аренды их дорассылка заберёт снова
+        if not future.cancelled():
+            coordinator.mark(claim, 'failed' if future.exception() is not None else 'sent')
+
+    pending: List[Tuple[Claim, asyncio.Future]] = []
+    for subscription, future in deliveries:
+        claim = by_id[subscription.id].pop()
+        future.add_done_callback(partial(on_done, claim=claim))
+        pending.append((claim, future))
+
+    # Отправка — до доставки последнего сообщения пачки, а не до постановки в очередь
+    enqueued = time.perf_counter()
+    heartbeat = asyncio.create_task(_hold_claims(coordinator, pending))
+    try:
+        results = await asyncio.gather(*(future for _, future in deliveries), return_exceptions=True)
+    finally:
+        heartbeat.cancel()
+    elapsed = time.perf_counter() - enqueued
+    DELIVERY_PHASE_SECONDS.labels('send').observe(elapsed)
+    logger.debug("Рассылка %s: пачка из %d сообщений отправлена за %.3fс", slot, len(deliveries), elapsed)
+    return sum(1 for result in results if not isinstance(result, BaseException))
+
+async def drain_deliveries(
+    coordinator: DeliveryCoordinator,
+    sender: MessageSender,
+    resolver: CityResolver,
+    slot_from: datetime,
+    slot_to: datetime,
+    slot: str,
+    prefetcher: Optional[Prefetcher] = None,
+) -> Tuple[int, int]:
+    """
+    Забирает и доставляет пачки записей со слотами в [slot_from, slot_to], пока они не кончатся.
+
+    Одновременно в работе не больше DELIVERY_MAX_INFLIGHT_BATCHES пачек: реплика не
+    забирает весь слот себе, и остальная его часть достаётся другим репликам.
+    Возвращает число захваченных и доставленных сообщений.
+    """
+    inflight = asyncio.Semaphore(settings.DELIVERY_MAX_INFLIGHT_BATCHES)
+    tasks: List[asyncio.Task] = []
+    claimed = 0
+
+    async def deliver(claims: List[Claim]) -> int:
+        try:
+            return await _deliver_claims(coordinator, claims, slot, sender, resolver, prefetcher)
+        finally:
+            inflight.release()
+
+    try:
+        while True:
+            await inflight.acquire()
+            try:
+                claims = await coordinator.claim(slot_from, slot_to)
+            except BaseException:
+                inflight.release()
+                raise
+            if not claims:
+                inflight.release()
+                break
+            claimed += len(claims)
+            tasks.append(_spawn(deliver(claims)))
+    finally:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error("Ошибка при доставке пачки рассылки %s: %s", slot, result)
+    delivered = sum(result for result in results if not isinstance(result, BaseException))
+    return claimed, delivered
+
+async def send_weather_update(
+    coordinator: DeliveryCoordinator,
+    sender: MessageSender,
+    resolver: CityResolver,
+    slot_at: datetime,
+    index: Optional[SubscriptionIndex] = None,
+    prefetcher: Optional[Prefetcher] = None,
+):
+    """
+    Ставит подписки слота slot_at в таблицу deliveries и доставляет захваченную часть.
+
+    С index подписки берутся из индекса в памяти (одна реплика), без него — из
+    таблицы users, чтобы все реплики ставили один и тот же набор.
+    """
+    slot = slot_at.strftime('%H:%M')
+    try:
+        logger.debug("Выполнение запланированной задачи на время: %s", slot)
+        # Опоздание тика: время от начала минуты слота до начала его рассылки
+        TICK_LAG_SECONDS.observe(max(0.0, time.time() - slot_at.timestamp()))
+        started = time.perf_counter()
+        subscriptions = None if index is None else index.due(minute_of_day(slot_at.time()))
+        enqueued = await coordinator.enqueue(slot_at, subscriptions)
+        claimed, delivered = await drain_deliveries(
+            coordinator, sender, resolver, slot_at, slot_at, slot, prefetcher
+        )
+        elapsed = time.perf_counter() - started
+        TICK_SECONDS.labels('slot').observe(elapsed)
+        logger.info(
+            "Рассылка %s (%s): поставлено %d, захвачено %d, доставлено %d за %.1fс",
+            slot, coordinator.replica_id, enqueued, claimed, delivered, elapsed,
+        )
+    except Exception as e:
+        logger.error("Ошибка при выполнении запланированной задачи %s: %s", slot, e)
+
+async def deliver_overdue(
+    coordinator: DeliveryCoordinator,
+    sender: MessageSender,
+    resolver: CityResolver,
+    prefetcher: Optional[Prefetcher] = None,
+):
+    """
+    Дорассылает записи прошедших слотов в пределах DELIVERY_GRACE_MINUTES, которые
+    никто не забрал или чья аренда истекла (реплика упала посреди рассылки).
+    """
+    now = datetime.now(MOSCOW_TZ).replace(second=0, microsecond=0)
+    slot_from = now - timedelta(minutes=settings.DELIVERY_GRACE_MINUTES)
+    try:
+        with TICK_SECONDS.labels('overdue').time():
+            claimed, delivered = await drain_deliveries(
+                coordinator, sender, resolver, slot_from, now - timedelta(minutes=1), 'досылка', prefetcher
+            )
+        if claimed:
+            logger.info("Дорассылка пропущенных слотов: захвачено %s, доставлено %s", claimed, delivered)
+    except Exception as e:
+        logger.error("Ошибка при дорассылке пропущенных слотов: %s", e)
+
+async def run_delivery_loop(
+    index: SubscriptionIndex,
+    coordinator: DeliveryCoordinator,
+    sender: MessageSender,
+    resolver: CityResolver,
+    prefetcher: Optional[Prefetcher] = None,
+):
+    """
+    Запускает рассылку в начале каждой непустой минуты.
+
+    Между рассылками спит до ближайшей минуты, на которую есть подписки, и
+    просыпается раньше, если индекс подписок изменился. В режиме coordinated
+    подписки слота ставятся в очередь из таблицы users, а не из индекса.
+    """
+    source = index if settings.SCHEDULER_MODE == 'local' else None
+    grace = settings.DELIVERY_GRACE_MINUTES
+    # После старта досылаем слоты за последние grace минут: уже доставленные
+    # отсеет первичный ключ таблицы deliveries
+    last_minute = (current_minute() - grace - 1) % MINUTES_PER_DAY
+    while True:
+        index.changed.clear()
+        now = datetime.now(MOSCOW_TZ)
+        current = minute_of_day(now.time())
+
+        # Обрабатываем текущую минуту и, если тик опоздал, пропущенные перед ней
+        missed = (current - last_minute) % MINUTES_PER_DAY
+        for offset in range(min(missed, grace + 1) - 1, -1, -1):
+            minute = (current - offset) % MINUTES_PER_DAY
+            if not index.due(minute):
+                continue
+            slot_at = now.replace(second=0, microsecond=0) - timedelta(minutes=offset)
+            _spawn(send_weather_update(coordinator, sender, resolver, slot_at, source, prefetcher))
+        last_minute = current
+
+        offset = index.next_minute(current + 1)
+        if offset is None:
+            delay = None
+        else:
+            wake_at = now.replace(second=0, microsecond=0) + timedelta(minutes=offset + 1)
+            # Ограничиваем сон часом, чтобы не зависеть от перевода системных часов
+            delay = min((wake_at - datetime.now(MOSCOW_TZ)).total_seconds(), 3600.0)
+
+        try:
+            await asyncio.wait_for(index.changed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
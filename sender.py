@@ -0,0 +1,199 @@
+# sender.py
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+from metrics import SEND_QUEUE_SECONDS, SEND_RESULTS, SEND_SECONDS
+from ratelimit import Priority, TokenBucket, KeyedTokenBuckets
+
+logger = logging.getLogger(__name__)
+
+# Окно (в секундах) для расчёта скорости доставки
+THROUGHPUT_WINDOW = 60.0
+
+@dataclass(order=True)
+class _Outgoing:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    text: str = field(compare=False)
+    kwargs: Dict[str, Any] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+    enqueued_at: float = field(default_factory=time.monotonic, compare=False)
+
+def _consume_exception(future: asyncio.Future):
+    # Ошибка уже залогирована воркером; помечаем её полученной, если результат никто не ждёт
+    if not future.cancelled():
+        future.exception()
+
+class MessageSender:
+    """
+    Очередь исходящих сообщений Telegram с пулом воркеров.
+
+    Интерактивные ответы обслуживаются раньше плановой рассылки. Общая скорость
+    ограничена глобальной корзиной токенов, скорость в каждый чат — отдельной.
+    При TelegramRetryAfter сообщение возвращается в очередь после retry_after секунд.
+    """
+    def __init__(
+        self,
+        bot: Bot,
+        workers: int = 8,
+        global_rate: float = 25.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_retries: int = 5,
+        max_chats: int = 100_000,
+    ):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = KeyedTokenBuckets(chat_rate, chat_burst, max_chats)
+        self._queue: 'asyncio.PriorityQueue[_Outgoing]' = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._tasks: List[asyncio.Task] = []
+        self._delayed = 0
+        self._sent_times: Deque[float] = deque()
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._depth = {priority: 0 for priority in Priority}
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info("Очередь отправки запущена: %s воркеров.", self.workers)
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Даёт очереди дослать сообщения в течение timeout секунд и останавливает воркеров.
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь отправки остановлена с %s недоставленными сообщениями.", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def send(self, chat_id: int, text: str, priority: Priority = Priority.INTERACTIVE, **kwargs) -> asyncio.Future:
+        """
+        Ставит сообщение в очередь. Возвращает future с результатом отправки.
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        item = _Outgoing(int(priority), next(self._seq), chat_id, text, kwargs, future)
+        self._put(item)
+        self.enqueued += 1
+        return future
+
+    def _put(self, item: _Outgoing):
+        self._depth[Priority(item.priority)] += 1
+        self._queue.put_nowait(item)
+
+    def _put_later(self, item: _Outgoing, delay: float):
+        self._delayed += 1
+
+        def put():
+            self._delayed -= 1
+            self._put(item)
+
+        asyncio.get_running_loop().call_later(delay, put)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            self._depth[Priority(item.priority)] -= 1
+            try:
+                await self._deliver(item)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, item: _Outgoing):
+        # Чат упёрся в свой лимит — откладываем сообщение, не блокируя воркер
+        chat_delay = self._chats.get(item.chat_id).delay()
+        if chat_delay > 0:
+            self._put_later(item, chat_delay)
+            return
+
+        await self._global.acquire()
+        if not self._chats.get(item.chat_id).try_acquire():
+            # Пока ждали общий токен, чат исчерпал лимит: токен возвращается, сообщение откладывается
+            self._global.refund()
+            self._put_later(item, self._chats.get(item.chat_id).delay())
+            return
+
+        priority = Priority(item.priority).name.lower()
+        started = time.monotonic()
+        try:
+            result = await self.bot.send_message(item.chat_id, item.text, **item.kwargs)
+        except TelegramRetryAfter as e:
+            # Flood control Telegram часто действует на весь бот: останавливаем и остальные воркеры
+            self._global.penalize(e.retry_after)
+            self._retry(item, e.retry_after, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(item, min(2 ** item.attempts, 30), e)
+        except Exception as e:
+            self.failed += 1
+            SEND_RESULTS.labels(priority, 'failed').inc()
+            logger.error("Ошибка при отправке сообщения в чат %s: %s", item.chat_id, e)
+            item.future.set_exception(e)
+        else:
+            self.sent += 1
+            SEND_RESULTS.labels(priority, 'sent').inc()
+            SEND_QUEUE_SECONDS.labels(priority).observe(time.monotonic() - item.enqueued_at)
+            self._sent_times.append(time.monotonic())
+            self._trim_sent_times()
+            item.future.set_result(result)
+        finally:
+            SEND_SECONDS.labels(priority).observe(time.monotonic() - started)
+
+    def _retry(self, item: _Outgoing, delay: float, error: Exception):
+        item.attempts += 1
+        priority = Priority(item.priority).name.lower()
+        if item.attempts > self.max_retries:
+            self.failed += 1
+            SEND_RESULTS.labels(priority, 'failed').inc()
+            logger.error("Сообщение в чат %s не доставлено после %s попыток: %s", item.chat_id, self.max_retries, error)
+            item.future.set_exception(error)
+            return
+        self.retried += 1
+        SEND_RESULTS.labels(priority, 'retried').inc()
+        self._chats.get(item.chat_id).penalize(delay)
+        logger.warning("Повтор отправки в чат %s через %sс (попытка %s): %s", item.chat_id, delay, item.attempts, error)
+        self._put_later(item, delay)
+
+    def _trim_sent_times(self):
+        threshold = time.monotonic() - THROUGHPUT_WINDOW
+        while self._sent_times and self._sent_times[0] < threshold:
+            self._sent_times.popleft()
+
+    def throughput(self) -> float:
+        """
+        Средняя скорость доставки (сообщений в секунду) за последнюю минуту.
+        """
+        self._trim_sent_times()
+        return len(self._sent_times) / THROUGHPUT_WINDOW
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': {priority.name.lower(): depth for priority, depth in self._depth.items()},
+            'delayed': self._delayed,
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'throughput': round(self.throughput(), 2),
+        }
@@ -0,0 +1,126 @@
+# subscriptions.py
+
+import asyncio
+import logging
+from datetime import datetime, time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import pytz
+
+from database import Repository
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+# Время уведомлений задаётся по Москве
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+class Subscription(NamedTuple):
+    id: int
+    user_id: int
+    city_id: Optional[int]  # None у старых записей, ещё не сопоставленных со справочником
+    city: str
+
+def minute_of_day(value: time) -> int:
+    return value.hour * 60 + value.minute
+
+def current_minute() -> int:
+    return minute_of_day(datetime.now(MOSCOW_TZ).time())
+
+class SubscriptionIndex:
+    """
+    Подписки в памяти, разложенные по 1440 минутам суток.
+
+    Загружается из таблицы users при старте, обновляется хендлерами точечно и
+    периодически пересинхронизируется с базой. Позволяет планировщику получать
+    подписки на текущую минуту без запроса к Postgres.
+    """
+    def __init__(self):
+        self._slots: List[Dict[int, Subscription]] = [{} for _ in range(MINUTES_PER_DAY)]
+        self._minutes: Dict[int, int] = {}  # id подписки -> минута суток
+        self._by_user: Dict[int, Set[int]] = {}
+        # Изменения, пришедшие во время пересинхронизации, применяются к новому индексу
+        self._journal: Optional[List[Tuple[str, tuple]]] = None
+        self.changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._minutes)
+
+    async def load(self, repo: Repository):
+        """
+        Полностью перестраивает индекс по таблице users.
+        """
+        self._journal = []
+        try:
+            rows = await repo.all_subscriptions()
+        except BaseException:
+            self._journal = None
+            raise
+
+        journal, self._journal = self._journal, None
+        self._slots = [{} for _ in range(MINUTES_PER_DAY)]
+        self._minutes = {}
+        self._by_user = {}
+        for row in rows:
+            self._add(row.id, row.user_id, row.city_id, row.city, minute_of_day(row.notification_time))
+        for op, args in journal:
+            getattr(self, op)(*args)
+
+        self.changed.set()
+        logger.info("Индекс подписок загружен: %s подписок.", len(self._minutes))
+
+    def _record(self, op: str, *args):
+        if self._journal is not None:
+            self._journal.append((op, args))
+        self.changed.set()
+
+    def _add(self, subscription_id: int, user_id: int, city_id: Optional[int], city: str, minute: int):
+        self._remove(subscription_id)
+        self._slots[minute][subscription_id] = Subscription(subscription_id, user_id, city_id, city)
+        self._minutes[subscription_id] = minute
+        self._by_user.setdefault(user_id, set()).add(subscription_id)
+
+    def _remove(self, subscription_id: int):
+        minute = self._minutes.pop(subscription_id, None)
+        if minute is None:
+            return
+        subscription = self._slots[minute].pop(subscription_id)
+        ids = self._by_user.get(subscription.user_id)
+        if ids is not None:
+            ids.discard(subscription_id)
+            if not ids:
+                del self._by_user[subscription.user_id]
+
+    def _remove_user(self, user_id: int):
+        for subscription_id in list(self._by_user.get(user_id, ())):
+            self._remove(subscription_id)
+
+    def add(self, subscription_id: int, user_id: int, city_id: int, city: str, notification_time: time):
+        """
+        Добавляет подписку или переносит существующую на новое время/город.
+        """
+        minute = minute_of_day(notification_time)
+        self._add(subscription_id, user_id, city_id, city, minute)
+        self._record('_add', subscription_id, user_id, city_id, city, minute)
+
+    def remove(self, subscription_id: int):
+        self._remove(subscription_id)
+        self._record('_remove', subscription_id)
+
+    def remove_user(self, user_id: int):
+        self._remove_user(user_id)
+        self._record('_remove_user', user_id)
+
+    def due(self, minute: int) -> List[Subscription]:
+        return list(self._slots[minute % MINUTES_PER_DAY].values())
+
+    def next_minute(self, start: int) -> Optional[int]:
+        """
+        Ближайшая непустая минута, начиная со start (по кругу суток), в виде смещения
+        от start в минутах; None, если подписок нет.
+        """
+        for offset in range(MINUTES_PER_DAY):
+            if self._slots[(start + offset) % MINUTES_PER_DAY]:
+                return offset
+        return None
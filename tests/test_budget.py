@@ -0,0 +1,78 @@
+# tests/test_budget.py
+
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_TOKEN', '1:test')
+os.environ.setdefault('WEATHER_API_KEY', 'test')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/test')
+
+import weather
+from budget import UpstreamBudget
+from circuit import CircuitBreaker
+from ratelimit import Priority
+
+NO_WAIT = {priority: 0.0 for priority in Priority}
+
+class UpstreamBudgetTest(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_limited_by_capacity(self):
+        budget = UpstreamBudget(per_minute=60, per_day=1000, reserve=0.0, max_wait=NO_WAIT)
+        results = [await budget.acquire() for _ in range(7)]
+        self.assertEqual(results, [True] * 6 + [False])
+        self.assertEqual(budget.granted[Priority.INTERACTIVE], 6)
+        self.assertEqual(budget.rejected[Priority.INTERACTIVE], 1)
+
+    async def test_reserve_kept_for_interactive(self):
+        budget = UpstreamBudget(per_minute=600, per_day=1000, reserve=0.5, max_wait=NO_WAIT)
+        # Ёмкость 60: плановым доступно, пока в корзине больше 1 + 30 токенов
+        scheduled = 0
+        while await budget.acquire(Priority.SCHEDULED):
+            scheduled += 1
+        self.assertEqual(scheduled, 30)
+        self.assertTrue(await budget.acquire(Priority.INTERACTIVE))
+
+    async def test_small_quota_still_grants_scheduled(self):
+        budget = UpstreamBudget(per_minute=5, per_day=1000, reserve=0.5, max_wait=NO_WAIT)
+        self.assertTrue(await budget.acquire(Priority.SCHEDULED))
+
+    async def test_day_limit_respects_reserve(self):
+        budget = UpstreamBudget(per_minute=600, per_day=2, reserve=0.5, max_wait=NO_WAIT)
+        self.assertTrue(await budget.acquire(Priority.PREFETCH))
+        self.assertFalse(await budget.acquire(Priority.PREFETCH))
+        self.assertTrue(await budget.acquire(Priority.INTERACTIVE))
+        self.assertFalse(await budget.acquire(Priority.INTERACTIVE))
+        self.assertEqual(budget.usage()['day_used'], 2)
+
+class RequestBudgetTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Взаимодействие бюджета и предохранителя в weather._request_json.
+    """
+    def setUp(self):
+        self.budget = UpstreamBudget(per_minute=60, per_day=1000, reserve=0.0, max_wait=NO_WAIT)
+        self.breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.0)
+        for name, value in (('budget', self.budget), ('breaker', self.breaker)):
+            patcher = mock.patch.object(weather, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_open_breaker_does_not_spend_budget(self):
+        self.breaker.reset_timeout = 60.0
+        self.breaker.record_failure()
+        with self.assertRaises(weather.CircuitOpen):
+            await weather._request_json('weather', {'id': 1})
+        self.assertEqual(self.budget.day_used, 0)
+        self.assertEqual(self.budget._bucket.tokens, self.budget._bucket.capacity)
+
+    async def test_budget_refusal_releases_probe(self):
+        self.breaker.record_failure()
+        self.budget.per_day = 0
+        with self.assertRaises(weather.BudgetExhausted):
+            await weather._request_json('weather', {'id': 1}, Priority.SCHEDULED)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNone(self.breaker._probe_started)
+        # Следующий вызов снова может стать пробным
+        self.assertTrue(self.breaker.allow())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# tests/test_cache.py
+
+import asyncio
+import unittest
+
+from cache import MemoryBackend, TwoTierCache
+
+class GetOrLoadTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = TwoTierCache('test', ttl=60.0, backend=MemoryBackend())
+        self.calls = 0
+
+    def loader(self, value=None, error=None, delay=0.01):
+        async def load():
+            self.calls += 1
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            return value
+        return load
+
+    async def test_concurrent_misses_load_once(self):
+        loader = self.loader({'t': 1})
+        results = await asyncio.gather(*(self.cache.get_or_load('k', loader) for _ in range(10)))
+        self.assertEqual(results, [{'t': 1}] * 10)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(await self.cache.get_or_load('k', loader), {'t': 1})
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache._inflight, {})
+
+    async def test_error_reaches_all_waiters(self):
+        loader = self.loader(error=ValueError('boom'))
+        results = await asyncio.gather(
+            *(self.cache.get_or_load('k', loader) for _ in range(3)), return_exceptions=True,
+        )
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(self.cache._inflight, {})
+
+        # Ошибка не кэшируется: следующий вызов загружает заново
+        self.assertEqual(await self.cache.get_or_load('k', self.loader('ok')), 'ok')
+        self.assertEqual(self.calls, 2)
+
+    async def test_none_is_not_cached(self):
+        self.assertIsNone(await self.cache.get_or_load('k', self.loader(None)))
+        self.assertIsNone(await self.cache.get_or_load('k', self.loader(None)))
+        self.assertEqual(self.calls, 2)
+
+    async def test_owner_cancellation_does_not_cancel_waiters(self):
+        owner = asyncio.create_task(self.cache.get_or_load('k', self.loader('slow', delay=1.0)))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(self.cache.get_or_load('k', self.loader('fresh')))
+        await asyncio.sleep(0)
+        owner.cancel()
+        self.assertEqual(await waiter, 'fresh')
+        with self.assertRaises(asyncio.CancelledError):
+            await owner
+        self.assertEqual(self.calls, 2)
+
+    async def test_min_ttl_forces_reload(self):
+        await self.cache.set('k', 'old', ttl=5.0)
+        self.assertEqual(await self.cache.get_or_load('k', self.loader('new')), 'old')
+        self.assertEqual(await self.cache.get_or_load('k', self.loader('new'), min_ttl=10.0), 'new')
+        self.assertEqual(self.calls, 1)
+
+if __name__ == '__main__':
+    unittest.main()
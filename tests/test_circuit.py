@@ -0,0 +1,82 @@
+# tests/test_circuit.py
+
+import unittest
+from unittest import mock
+
+from circuit import CircuitBreaker
+from test_ratelimit import Clock
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('circuit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=10.0)
+
+    def trip(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.trips, 1)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.rejected, 1)
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_lets_single_probe(self):
+        self.trip()
+        self.clock.advance(10.0)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_probe_success_closes(self):
+        self.trip()
+        self.clock.advance(10.0)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_failure_reopens(self):
+        self.trip()
+        self.clock.advance(10.0)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.trips, 2)
+        self.clock.advance(5.0)
+        self.assertFalse(self.breaker.allow())
+
+    def test_release_frees_probe_slot(self):
+        self.trip()
+        self.clock.advance(10.0)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.assertTrue(self.breaker.allow())
+
+    def test_lost_probe_is_replaced_after_timeout(self):
+        self.trip()
+        self.clock.advance(10.0)
+        self.assertTrue(self.breaker.allow())
+        self.clock.advance(9.0)
+        self.assertFalse(self.breaker.allow())
+        self.clock.advance(1.0)
+        self.assertTrue(self.breaker.allow())
+
+if __name__ == '__main__':
+    unittest.main()
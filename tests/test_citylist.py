@@ -0,0 +1,32 @@
+# tests/test_citylist.py
+
+import unittest
+
+from citylist import CityIndex
+
+class CityIndexTransliterationTest(unittest.TestCase):
+    def setUp(self):
+        self.index = CityIndex()
+        self.index.build([
+            (520555, 'Nizhniy Novgorod', 'RU'),
+            (466806, 'Yoshkar-Ola', 'RU'),
+            (1486209, 'Yekaterinburg', 'RU'),
+            (524901, 'Moscow', 'RU'),
+        ])
+
+    def assertFinds(self, query: str, name: str):
+        self.assertIn(name, [entry.name for entry in self.index.search(query)])
+
+    def test_short_i(self):
+        self.assertFinds('Нижний', 'Nizhniy Novgorod')
+        self.assertFinds('Йошкар', 'Yoshkar-Ola')
+
+    def test_leading_ye(self):
+        self.assertFinds('Екатеринбург', 'Yekaterinburg')
+        self.assertFinds('екат', 'Yekaterinburg')
+
+    def test_latin_query(self):
+        self.assertFinds('mos', 'Moscow')
+
+if __name__ == '__main__':
+    unittest.main()
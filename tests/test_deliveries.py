@@ -0,0 +1,98 @@
+# tests/test_deliveries.py
+
+import asyncio
+import os
+import time
+import unittest
+from collections import Counter
+from datetime import datetime
+from unittest import mock
+
+os.environ.setdefault('TELEGRAM_TOKEN', '1:test')
+os.environ.setdefault('WEATHER_API_KEY', 'test')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/test')
+
+import scheduler
+from deliveries import Claim
+from subscriptions import MOSCOW_TZ, Subscription
+
+SLOT_AT = datetime(2024, 1, 1, 8, 0, tzinfo=MOSCOW_TZ)
+
+class MemoryCoordinator:
+    """
+    Таблица deliveries в памяти с теми же правилами захвата и аренды, что и в DeliveryCoordinator.
+    """
+    def __init__(self, subscriptions, lease: float, batch_size: int):
+        self.lease = lease
+        self.batch_size = batch_size
+        self.replica_id = 'test'
+        self.rows = {subscription.id: {'subscription': subscription, 'status': 'pending', 'claimed_at': 0.0}
+                     for subscription in subscriptions}
+
+    async def claim(self, slot_from, slot_to):
+        now = time.monotonic()
+        claims = []
+        for row in self.rows.values():
+            expired = row['status'] == 'claimed' and row['claimed_at'] < now - self.lease
+            if row['status'] == 'pending' or expired:
+                row['status'], row['claimed_at'] = 'claimed', now
+                claims.append(Claim(SLOT_AT, row['subscription']))
+                if len(claims) == self.batch_size:
+                    break
+        return claims
+
+    async def extend(self, claims):
+        for claim in claims:
+            row = self.rows[claim.subscription.id]
+            if row['status'] == 'claimed':
+                row['claimed_at'] = time.monotonic()
+
+    def mark(self, claim, status):
+        self.rows[claim.subscription.id]['status'] = status
+
+class SlowSender:
+    """
+    Отправляет по одному сообщению за interval секунд, как очередь, упёршаяся в общий лимит.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.sent = Counter()
+        self._ready_at = 0.0
+
+    def send(self, chat_id, text, priority=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._ready_at = max(self._ready_at, loop.time()) + self.interval
+
+        def done():
+            self.sent[chat_id] += 1
+            future.set_result(True)
+
+        loop.call_at(self._ready_at, done)
+        return future
+
+class LeaseTest(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_queue_is_not_sent_twice(self):
+        subscriptions = [Subscription(i, 100 + i, i, f'Город {i}') for i in range(6)]
+        coordinator = MemoryCoordinator(subscriptions, lease=0.15, batch_size=2)
+        sender = SlowSender(interval=0.1)
+
+        async def no_forecasts(city_ids, concurrency):
+            return {}
+
+        with mock.patch.object(scheduler, '_fetch_forecasts', no_forecasts), \
+                mock.patch.object(scheduler.settings, 'DELIVERY_MAX_INFLIGHT_BATCHES', 3):
+            first = asyncio.create_task(
+                scheduler.drain_deliveries(coordinator, sender, None, SLOT_AT, SLOT_AT, '08:00')
+            )
+            # Вторая «реплика» приходит уже после истечения аренды, пока очередь ещё не разобрана
+            await asyncio.sleep(0.3)
+            second = await scheduler.drain_deliveries(coordinator, sender, None, SLOT_AT, SLOT_AT, '08:00')
+            await first
+
+        self.assertEqual(second, (0, 0))
+        self.assertEqual(sender.sent, Counter({100 + i: 1 for i in range(6)}))
+        self.assertTrue(all(row['status'] == 'sent' for row in coordinator.rows.values()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# tests/test_ratelimit.py
+
+import unittest
+from unittest import mock
+
+import ratelimit
+from ratelimit import KeyedTokenBuckets, TokenBucket
+
+class Clock:
+    """
+    Подменяет time.monotonic в модуле: время двигается только через advance.
+    """
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('ratelimit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_starts_full_and_drains(self):
+        bucket = TokenBucket(rate=1.0, capacity=3)
+        self.assertTrue(all(bucket.try_acquire() for _ in range(3)))
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.delay(), 1.0)
+
+    def test_refill_is_capped_by_capacity(self):
+        bucket = TokenBucket(rate=2.0, capacity=4)
+        for _ in range(4):
+            bucket.try_acquire()
+        self.clock.advance(1.0)
+        self.assertAlmostEqual(bucket.delay(), 0.0)
+        self.assertAlmostEqual(bucket.tokens, 2.0)
+        self.clock.advance(60.0)
+        bucket.delay()
+        self.assertAlmostEqual(bucket.tokens, 4.0)
+
+    def test_refund_does_not_exceed_capacity(self):
+        bucket = TokenBucket(rate=1.0, capacity=2)
+        bucket.try_acquire()
+        bucket.refund()
+        bucket.refund()
+        self.assertEqual(bucket.tokens, 2.0)
+
+    def test_penalize_freezes_bucket(self):
+        bucket = TokenBucket(rate=10.0, capacity=10)
+        bucket.penalize(5.0)
+        self.assertAlmostEqual(bucket.delay(), 5.0 + 0.1)
+        self.assertFalse(bucket.try_acquire())
+
+        # Во время штрафа токены не накапливаются
+        self.clock.advance(4.0)
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.delay(), 1.0 + 0.1)
+
+        self.clock.advance(1.1)
+        self.assertTrue(bucket.try_acquire())
+
+    def test_penalize_does_not_shorten_previous_penalty(self):
+        bucket = TokenBucket(rate=1.0, capacity=1)
+        bucket.penalize(10.0)
+        bucket.penalize(2.0)
+        self.assertAlmostEqual(bucket.delay(), 10.0 + 1.0)
+
+class KeyedTokenBucketsTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        buckets = KeyedTokenBuckets(rate=1.0, capacity=1, max_size=2)
+        first = buckets.get('a')
+        buckets.get('b')
+        self.assertIs(buckets.get('a'), first)
+        buckets.get('c')
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(buckets.evictions, 1)
+        # Вытеснена 'b', к которой обращались раньше, чем к 'a'
+        self.assertIs(buckets.get('a'), first)
+        self.assertEqual(buckets.evictions, 1)
+        self.assertNotIn('b', buckets._buckets)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# tests/test_subscriptions.py
+
+import unittest
+from datetime import time
+
+from subscriptions import MINUTES_PER_DAY, Subscription, SubscriptionIndex
+
+class SubscriptionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SubscriptionIndex()
+
+    def test_add_and_due(self):
+        self.index.add(1, 10, 100, 'Москва', time(8, 30))
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.due(8 * 60 + 30), [Subscription(1, 10, 100, 'Москва')])
+        self.assertEqual(self.index.due(8 * 60 + 31), [])
+        self.assertTrue(self.index.changed.is_set())
+
+    def test_add_moves_existing_subscription(self):
+        self.index.add(1, 10, 100, 'Москва', time(8, 30))
+        self.index.add(1, 10, 200, 'Казань', time(9, 0))
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.due(8 * 60 + 30), [])
+        self.assertEqual(self.index.due(9 * 60), [Subscription(1, 10, 200, 'Казань')])
+
+    def test_remove(self):
+        self.index.add(1, 10, 100, 'Москва', time(8, 30))
+        self.index.add(2, 10, 200, 'Казань', time(8, 30))
+        self.index.remove(1)
+        self.index.remove(1)  # повторное удаление ничего не ломает
+        self.assertEqual(self.index.due(8 * 60 + 30), [Subscription(2, 10, 200, 'Казань')])
+
+    def test_remove_user(self):
+        self.index.add(1, 10, 100, 'Москва', time(8, 30))
+        self.index.add(2, 10, 200, 'Казань', time(20, 0))
+        self.index.add(3, 11, 100, 'Москва', time(8, 30))
+        self.index.remove_user(10)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.due(8 * 60 + 30), [Subscription(3, 11, 100, 'Москва')])
+        self.assertEqual(self.index.due(20 * 60), [])
+
+    def test_next_minute(self):
+        self.assertIsNone(self.index.next_minute(0))
+        self.index.add(1, 10, 100, 'Москва', time(8, 30))
+        self.assertEqual(self.index.next_minute(8 * 60), 30)
+        self.assertEqual(self.index.next_minute(8 * 60 + 30), 0)
+
+    def test_next_minute_wraps_around_midnight(self):
+        self.index.add(1, 10, 100, 'Москва', time(0, 5))
+        self.assertEqual(self.index.next_minute(23 * 60 + 50), 15)
+        self.assertEqual(self.index.next_minute(0 * 60 + 6), MINUTES_PER_DAY - 1)
+        self.assertEqual(self.index.due(MINUTES_PER_DAY + 5), [Subscription(1, 10, 100, 'Москва')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,33 +1,388 @@
 # weather.py
 
 import aiohttp
+import asyncio
 import logging
+import time
 from config import settings
-from typing import Optional
-from tenacity import retry, stop_after_attempt, wait_exponential
-from aiocache import cached, SimpleMemoryCache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from cache import TwoTierCache
+from budget import UpstreamBudget
+from circuit import CircuitBreaker
+from forecast import Conditions, Forecast
+from metrics import UPSTREAM_RESPONSES, UPSTREAM_SECONDS, WEATHER_RESULTS, WEATHER_SECONDS
+from ratelimit import Priority
 
 logger = logging.getLogger(__name__)
 
-@cached(ttl=600, cache=SimpleMemoryCache)
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-async def get_weather(city_name: str, hours: int = 24) -> Optional[dict]:
+class WeatherError(Exception):
     """
-    Получает прогноз погоды по названию города на заданное количество часов.
+    Ошибка обращения к OpenWeather.
     """
+
+class CityNotFound(WeatherError):
+    """
+    OpenWeather не знает такого города (404).
+    """
+
+class UpstreamThrottled(WeatherError):
+    """
+    OpenWeather ограничил частоту запросов (429).
+    """
+
+class UpstreamUnavailable(WeatherError):
+    """
+    Временная ошибка: сеть, таймаут или 5xx. Такие запросы повторяются.
+    """
+
+class CircuitOpen(WeatherError):
+    """
+    Предохранитель открыт: OpenWeather недавно был недоступен, запрос не отправлялся.
+    """
+
+class BudgetExhausted(WeatherError):
+    """
+    Квота вызовов OpenWeather не позволила выполнить запрос с таким приоритетом.
+    """
+
+# Бюджет вызовов OpenWeather, общий для всех запросов процесса
+budget = UpstreamBudget(
+    per_minute=settings.WEATHER_CALLS_PER_MINUTE,
+    per_day=settings.WEATHER_CALLS_PER_DAY,
+    reserve=settings.WEATHER_INTERACTIVE_RESERVE,
+    max_wait={
+        Priority.INTERACTIVE: settings.WEATHER_INTERACTIVE_MAX_WAIT,
+        Priority.SCHEDULED: settings.WEATHER_SCHEDULED_MAX_WAIT,
+        Priority.PREFETCH: settings.WEATHER_PREFETCH_MAX_WAIT,
+    },
+)
+
+# Предохранитель для всех запросов к OpenWeather
+breaker = CircuitBreaker(
+    'openweather',
+    failure_threshold=settings.WEATHER_BREAKER_THRESHOLD,
+    reset_timeout=settings.WEATHER_BREAKER_RESET,
+)
+
+def _make_caches(backend=None):
+    return (
+        TwoTierCache(
+            'forecast', ttl=settings.WEATHER_CACHE_TTL, backend=backend, local_size=settings.CACHE_LOCAL_SIZE,
+            dumps=Forecast.dumps, loads=Forecast.loads,
+        ),
+        # Последний успешный прогноз, который отдаётся, пока OpenWeather недоступен
+        TwoTierCache(
+            'forecast_stale', ttl=settings.WEATHER_STALE_TTL, backend=backend, local_size=settings.CACHE_LOCAL_SIZE,
+            dumps=Forecast.dumps, loads=Forecast.loads,
+        ),
+        # Города, которых нет в OpenWeather
+        TwoTierCache('forecast_missing', ttl=settings.WEATHER_NEGATIVE_TTL, backend=backend, local_size=settings.CACHE_LOCAL_SIZE),
+        # Текущая погода из /group
+        TwoTierCache(
+            'conditions', ttl=settings.CONDITIONS_CACHE_TTL, backend=backend, local_size=settings.CACHE_LOCAL_SIZE,
+            dumps=Conditions.dumps, loads=Conditions.loads,
+        ),
+        # Последняя полученная текущая погода на время недоступности OpenWeather
+        TwoTierCache(
+            'conditions_stale', ttl=settings.WEATHER_STALE_TTL, backend=backend, local_size=settings.CACHE_LOCAL_SIZE,
+            dumps=Conditions.dumps, loads=Conditions.loads,
+        ),
+    )
+
+# Кэши прогнозов; по умолчанию только в памяти процесса, общий уровень подключается через configure_cache
+_forecast_cache, _stale_cache, _missing_cache, _conditions_cache, _conditions_stale_cache = _make_caches()
+
+# Общая HTTP-сессия приложения: создаётся в bot.main и закрывается при остановке
+_session: Optional[aiohttp.ClientSession] = None
+
+async def init_http_session() -> aiohttp.ClientSession:
+    """
+    Создаёт долгоживущую HTTP-сессию с пулом соединений, keep-alive и кэшем DNS.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+
+    connector = aiohttp.TCPConnector(
+        limit=settings.HTTP_POOL_SIZE,
+        limit_per_host=settings.HTTP_POOL_SIZE_PER_HOST,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=settings.HTTP_TIMEOUT,
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+    )
+    _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    logger.info("HTTP-сессия создана (пул соединений: %s).", settings.HTTP_POOL_SIZE)
+    return _session
+
+async def close_http_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+        logger.info("HTTP-сессия закрыта.")
+
+def get_http_session() -> aiohttp.ClientSession:
+    if _session is None or _session.closed:
+        raise RuntimeError("HTTP-сессия не инициализирована: вызовите init_http_session()")
+    return _session
+
+async def _request_json(path: str, params: dict, priority: Priority = Priority.INTERACTIVE) -> dict:
+    """
+    Выполняет GET-запрос к OpenWeather через общую сессию и классифицирует ошибки.
+    """
+    if not breaker.allow():
+        UPSTREAM_RESPONSES.labels(path, 'circuit_open').inc()
+        raise CircuitOpen(f"OpenWeather временно недоступен ({path})")
+    acquired = False
+    try:
+        acquired = await budget.acquire(priority)
+    finally:
+        # Иначе в half_open место пробного вызова заняли бы до конца reset_timeout без результата
+        if not acquired:
+            breaker.release()
+    if not acquired:
+        UPSTREAM_RESPONSES.labels(path, 'budget').inc()
+        raise BudgetExhausted(f"{path}: квота исчерпана для приоритета {priority.name}")
+
+    url = f"{settings.OPENWEATHER_BASE_URL}/{path}"
+    params = {'units': 'metric', 'lang': 'ru', 'appid': settings.WEATHER_API_KEY, **params}
+    started = time.perf_counter()
     try:
-        url = "https://api.openweathermap.org/data/2.5/forecast"
-        params = {
-            'q': city_name,
-            'units': 'metric',
-            'lang': 'ru',
-            'appid': settings.WEATHER_API_KEY
+        async with get_http_session().get(url, params=params) as response:
+            UPSTREAM_RESPONSES.labels(path, str(response.status)).inc()
+            if response.status == 404:
+                breaker.record_success()
+                raise CityNotFound(f"{path}: {params.get('q') or params.get('id')}")
+            if response.status == 429:
+                breaker.record_failure()
+                raise UpstreamThrottled(f"{path}: 429 Too Many Requests")
+            if response.status >= 500:
+                breaker.record_failure()
+                raise UpstreamUnavailable(f"{path}: {response.status} {response.reason}")
+            if response.status >= 400:
+                breaker.record_success()
+                raise WeatherError(f"{path}: {response.status} {response.reason}")
+            data = await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        UPSTREAM_RESPONSES.labels(path, 'network').inc()
+        breaker.record_failure()
+        raise UpstreamUnavailable(f"{path}: {e!r}") from e
+    finally:
+        UPSTREAM_SECONDS.labels(path).observe(time.perf_counter() - started)
+
+    breaker.record_success()
+    return data
+
+# Повторяем только временные ошибки, с экспоненциальной задержкой и случайным разбросом
+_retry_transient = retry(
+    retry=retry_if_exception_type(UpstreamUnavailable),
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(multiplier=0.5, max=5),
+    reraise=True,
+)
+
+def configure_cache(backend) -> TwoTierCache:
+    """
+    Подключает общий уровень кэша (Postgres или его заменитель в памяти).
+    """
+    global _forecast_cache, _stale_cache, _missing_cache, _conditions_cache, _conditions_stale_cache
+    _forecast_cache, _stale_cache, _missing_cache, _conditions_cache, _conditions_stale_cache = _make_caches(backend)
+    return _forecast_cache
+
+def get_forecast_cache() -> TwoTierCache:
+    return _forecast_cache
+
+def get_conditions_cache() -> TwoTierCache:
+    return _conditions_cache
+
+@_retry_transient
+async def _fetch_forecast(city_id: int, priority: Priority) -> dict:
+    return await _request_json('forecast', {'id': city_id}, priority)
+
+async def _load_forecast(city_id: int, priority: Priority) -> Forecast:
+    data = await _fetch_forecast(city_id, priority)
+    forecast = Forecast.from_api(city_id, data, fetched_at=int(time.time()))
+    await _stale_cache.set(str(city_id), forecast)
+    return forecast
+
+async def get_weather(city_id: int, priority: Priority = Priority.INTERACTIVE, min_ttl: float = 0.0) -> Optional[Forecast]:
+    """
+    Получает прогноз погоды по идентификатору города OpenWeather. С min_ttl
+    прогноз из кэша, который истечёт раньше чем через min_ttl секунд, загружается заново.
+
+    Если OpenWeather недоступен или квота вызовов для priority исчерпана,
+    возвращает последний сохранённый прогноз (или None).
+    """
+    label = priority.name.lower()
+    with WEATHER_SECONDS.labels(label).time():
+        forecast, result = await _get_weather(city_id, priority, min_ttl)
+    WEATHER_RESULTS.labels(label, result).inc()
+    return forecast
+
+async def _get_weather(city_id: int, priority: Priority, min_ttl: float) -> Tuple[Optional[Forecast], str]:
+    key = str(city_id)
+    if await _missing_cache.get(key):
+        return None, 'not_found'
+    try:
+        return await _forecast_cache.get_or_load(key, lambda: _load_forecast(city_id, priority), min_ttl), 'ok'
+    except CityNotFound:
+        await _missing_cache.set(key, True)
+        logger.warning("Город %s не найден в OpenWeather.", city_id)
+        return None, 'not_found'
+    except WeatherError as e:
+        stale = await _stale_cache.get(key)
+        logger.warning(
+            "Ошибка при получении прогноза погоды для города %s: %s; %s.",
+            city_id, e, 'отдаём сохранённый прогноз' if stale else 'сохранённого прогноза нет',
+        )
+        return stale, 'stale' if stale else 'error'
+
+@_retry_transient
+async def lookup_city(query: str, priority: Priority = Priority.INTERACTIVE) -> dict:
+    """
+    Ищет город по произвольному названию. Возвращает текущую погоду OpenWeather,
+    в которой есть идентификатор, каноническое название и координаты города.
+
+    Бросает CityNotFound, если города нет, и WeatherError при прочих ошибках.
+    """
+    return await _request_json('weather', {'q': query}, priority)
+
+@_retry_transient
+async def _fetch_group(city_ids: List[int], priority: Priority) -> dict:
+    return await _request_json('group', {'id': ','.join(map(str, city_ids))}, priority)
+
+class GroupBatcher:
+    """
+    Сводит запросы текущей погоды разных городов в вызовы /group.
+
+    Запрошенные id копятся window секунд или пока их не наберётся size, затем
+    уходят одним вызовом. Пачка выполняется с самым высоким приоритетом из
+    запросивших её. Города, которых нет в ответе, получают None.
+    """
+    def __init__(self, window: float, size: int):
+        self.window = window
+        self.size = size
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._priority = Priority.PREFETCH
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.requested = 0
+        self.batches = 0
+        self.failed = 0
+
+    def load(self, city_id: int, priority: Priority) -> asyncio.Future:
+        future = self._pending.get(city_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(_consume_exception)
+            self._pending[city_id] = future
+            self.requested += 1
+        self._priority = min(self._priority, priority)
+        if len(self._pending) >= self.size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        priority, self._priority = self._priority, Priority.PREFETCH
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._fetch(batch, priority))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, batch: Dict[int, asyncio.Future], priority: Priority):
+        self.batches += 1
+        found: Dict[int, Conditions] = {}
+        try:
+            data = await _fetch_group(list(batch), priority)
+            fetched_at = int(time.time())
+            for entry in data.get('list', []):
+                conditions = Conditions.from_api(entry, fetched_at)
+                found[conditions.city_id] = conditions
+        except CityNotFound:
+            pass
+        except BaseException as e:
+            self.failed += 1
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for city_id, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(city_id))
+        # Копия для отдачи при сбоях пишется после ответа ожидающим, чтобы не задерживать их
+        await asyncio.gather(*(
+            _conditions_stale_cache.set(str(city_id), conditions) for city_id, conditions in found.items()
+        ))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'requested': self.requested,
+            'batches': self.batches,
+            'failed': self.failed,
+            'pending': len(self._pending),
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return data
-    except Exception as e:
-        logger.error(f"Ошибка при получении прогноза погоды для города {city_name}: {e}")
-        return None
+
+def _consume_exception(future: asyncio.Future):
+    # Ошибку пачки получает каждый ожидающий; помечаем её полученной, если ожидающих нет
+    if not future.cancelled():
+        future.exception()
+
+# Пачки запросов текущей погоды, общие для всех вызовов процесса
+group_batcher = GroupBatcher(settings.GROUP_BATCH_WINDOW, settings.GROUP_BATCH_SIZE)
+
+async def get_conditions(
+    city_ids: Iterable[int],
+    priority: Priority = Priority.INTERACTIVE,
+    min_ttl: float = 0.0,
+) -> Dict[int, Optional[Conditions]]:
+    """
+    Текущая погода для набора городов: из кэша, а промахи — вызовами /group по
+    GROUP_BATCH_SIZE городов, в том числе вместе с промахами других одновременных вызовов.
+
+    Если OpenWeather недоступен или квота вызовов для priority исчерпана, город
+    получает последнюю сохранённую сводку, а если её нет — None.
+    """
+    async def load(city_id: int) -> Optional[Conditions]:
+        # shield: отмена одного ожидающего не отменяет пачку для остальных
+        return await _conditions_cache.get_or_load(
+            str(city_id), lambda: asyncio.shield(group_batcher.load(city_id, priority)), min_ttl
+        )
+
+    city_ids = list(dict.fromkeys(city_ids))
+    results = await asyncio.gather(*(load(city_id) for city_id in city_ids), return_exceptions=True)
+    conditions: Dict[int, Optional[Conditions]] = {}
+    errors: List[BaseException] = []
+    failed: List[int] = []
+    for city_id, result in zip(city_ids, results):
+        if isinstance(result, BaseException):
+            errors.append(result)
+            if isinstance(result, WeatherError):
+                failed.append(city_id)
+            result = None
+        conditions[city_id] = result
+    if errors:
+        stale = await asyncio.gather(*(_conditions_stale_cache.get(str(city_id)) for city_id in failed))
+        served = 0
+        for city_id, result in zip(failed, stale):
+            if result is not None:
+                conditions[city_id] = result
+                served += 1
+        logger.warning(
+            "Текущая погода не получена для %d из %d городов: %r; сохранённая сводка отдана для %d.",
+            len(errors), len(city_ids), errors[0], served,
+        )
+    return conditions
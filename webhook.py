@@ -0,0 +1,107 @@
+# webhook.py
+
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from metrics import UPDATE_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookServer:
+    """
+    Приём апдейтов Telegram через вебхук на встроенном aiohttp-сервере.
+
+    Апдейт подтверждается ответом 200 сразу после разбора, а обрабатывается в
+    фоне: одновременно не более max_concurrency апдейтов. Если в работе уже
+    max_pending апдейтов, сервер отвечает 503, и Telegram повторит доставку позже.
+    """
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        path: str,
+        secret: Optional[str] = None,
+        max_concurrency: int = 64,
+        max_pending: int = 1000,
+        health: Optional[Callable[[], Dict[str, Any]]] = None,
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.max_pending = max_pending
+        self.health = health
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+        self._runner: Optional[web.AppRunner] = None
+
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get('/health', self.handle_health)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=401)
+        if len(self._tasks) >= self.max_pending:
+            self.rejected += 1
+            UPDATE_REJECTIONS.labels('backlog').inc()
+            return web.Response(status=503)
+
+        try:
+            update = Update(**await request.json())
+        except Exception as e:
+            logger.warning("Некорректный апдейт во вебхуке: %s", e)
+            return web.Response(status=400)
+
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.accepted += 1
+        return web.Response()
+
+    async def _process(self, update: Update):
+        async with self._semaphore:
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self.failed += 1
+                logger.error("Ошибка при обработке апдейта %s: %s", update.update_id, e)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        status = {
+            'status': 'ok',
+            'pending': len(self._tasks),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+        if self.health is not None:
+            status.update(self.health())
+        return web.json_response(status)
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Вебхук слушает http://%s:%s%s", host, port, self.path)
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Перестаёт принимать апдейты и даёт принятым обработаться в течение timeout секунд.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)